@@ -1,14 +1,29 @@
 """python -m organic_company_history.basis"""
 import polars as pl
 from loguru import logger
-from typing import NamedTuple
-from functools import lru_cache
+from typing import Any, Literal, Mapping, NamedTuple
+from pathlib import Path
+from functools import lru_cache, partial
+from datetime import date
 import random
 import pandera as pa
 from pandera.typing import DataFrame
 from pandera.polars import DataFrameModel
 
-from .polars_llm import PolarsLLM
+from .polars_llm import PolarsLLM, OutputFormat, DEFAULT_CONCURRENCY
+from .clients import client_pool
+from .scheduler import Stage, run_stages
+from .tables import generate_table
+from .validation import compile_schema, validate
+from .timesheet_patterns import WEEKDAYS, TIMESHEET_WEEKS, expand_timesheet_patterns
+from .checkpoints import (
+    Checkpoints,
+    Parts,
+    checkpoint_stage,
+    read_parquet,
+    write_parquet,
+)
+from . import database
 
 NUM_EMPLOYEES = 5
 MIN_UNIQUE_PAYCODES = 8
@@ -16,6 +31,15 @@ MIN_UNIQUE_TIMECODES = 6
 MIN_PRODUCTS = 4
 MAX_TIMESHEETS = 6
 FTE_HOURS_PER_WEEK = 35
+EMPLOYEES_PER_PROMPT = 1
+MAX_EMPLOYEE_ROUNDS = 3
+EMPLOYEES_PER_PAGE = 20
+PRODUCTS_PER_PAGE = 20
+JOB_TITLES_PER_PROMPT = 5
+
+TimesheetMode = Literal["llm", "patterns"]
+"""Whether the LLM fills in every employee's timesheets, or a weekly pattern per job
+title that is expanded into timesheets, see `expand_timesheet_patterns`"""
 
 
 class HR(DataFrameModel):
@@ -32,6 +56,7 @@ class HR(DataFrameModel):
 
 
 class Payroll(DataFrameModel):
+    employee_code: pa.String
     pay_code: pa.String
     hours: float = pa.Field(nullable=True)
     amount: float
@@ -56,21 +81,19 @@ class TimesheetCodes(DataFrameModel):
 
 
 class Timesheets(DataFrameModel):
-    weekday: pa.String = pa.Field(
-        isin=[
-            "Monday",
-            "Tuesday",
-            "Wednesday",
-            "Thursday",
-            "Friday",
-            "Saturday",
-            "Sunday",
-        ]
-    )
+    employee_code: pa.String
+    weekday: pa.String = pa.Field(isin=list(WEEKDAYS))
     time_code: pa.String
     hours: float
 
 
+class TimesheetPatterns(DataFrameModel):
+    job_title: pa.String
+    weekday: pa.String = pa.Field(isin=list(WEEKDAYS))
+    time_code: pa.String
+    share: float
+
+
 class ProductLine(DataFrameModel):
     product_category: pa.String
     product_name: pa.String
@@ -83,7 +106,10 @@ class Experts(NamedTuple):
     hr: PolarsLLM
     payroll_admin: PolarsLLM
     timesheet_admin: PolarsLLM
-    timesheet_data_entry: PolarsLLM
+    timesheet_data_entry: PolarsLLM | None
+    """None in the "patterns" timesheet_mode"""
+    timesheet_planner: PolarsLLM | None
+    """None in the "llm" timesheet_mode"""
     payroll_data_entry: PolarsLLM
     product_expert: PolarsLLM
 
@@ -105,9 +131,72 @@ def format_code_description_as_listing(
     return str().join("\n    - " + df[code] + ": " + df[description])
 
 
-def make_data_for_industry(industry: str) -> GeneratedData:
-    experts = init_experts(industry)
-    data = generate_data(experts)
+def industry_slug(industry: str) -> str:
+    return industry.replace(" ", "-")
+
+
+def save_generated_data(data: GeneratedData, directory: Path) -> None:
+    """Writes each table of `data` to a parquet file in `directory`"""
+    directory.mkdir(parents=True, exist_ok=True)
+    for name, df in data._asdict().items():
+        write_parquet(df, directory / f"{name}.parquet")
+
+
+def load_generated_data(directory: Path) -> GeneratedData:
+    """Reads the tables saved by `save_generated_data`, or the stages of a finished
+    run in its checkpoint directory"""
+    return GeneratedData(
+        **{
+            name: read_parquet(directory / f"{name}.parquet")
+            for name in GeneratedData._fields
+        }
+    )
+
+
+def make_data_for_industry(
+    industry: str,
+    max_concurrency: int = DEFAULT_CONCURRENCY,
+    employees_per_prompt: int = EMPLOYEES_PER_PROMPT,
+    num_employees: int = NUM_EMPLOYEES,
+    num_products: int = MIN_PRODUCTS,
+    table_dir: Path | None = None,
+    checkpoint_dir: Path | None = None,
+    resume: bool = False,
+    timesheet_mode: TimesheetMode = "llm",
+    timesheet_weeks: int = TIMESHEET_WEEKS,
+    **expert_options: Any,
+) -> GeneratedData:
+    """Generates data for `industry`. With a `checkpoint_dir`, each stage (and each
+    batch of employees) is saved there as it finishes, and with `resume` a run
+    that stopped part way is carried on from its checkpoints. See `make_stages`
+    for `timesheet_mode`."""
+    checkpoints = (
+        Checkpoints(checkpoint_dir, resume=resume) if checkpoint_dir else None
+    )
+    run_id = database.writer.insert(database.Run, label=industry)
+    token = database.current_run_id.set(run_id)
+    try:
+        experts = init_experts(
+            industry,
+            num_employees=num_employees,
+            num_products=num_products,
+            timesheet_mode=timesheet_mode,
+            **expert_options,
+        )
+        data = generate_data(
+            experts,
+            max_concurrency=max_concurrency,
+            employees_per_prompt=employees_per_prompt,
+            num_employees=num_employees,
+            num_products=num_products,
+            table_dir=table_dir,
+            checkpoints=checkpoints,
+            timesheet_mode=timesheet_mode,
+            timesheet_weeks=timesheet_weeks,
+        )
+    finally:
+        database.current_run_id.reset(token)
+
     return data
 
 
@@ -135,15 +224,91 @@ def get_number_of_hours_worked_for_day(
     return random.randrange(start=0, stop=16)
 
 
-def init_experts(industry: str) -> Experts:
-    name_prefix = f"user/{industry.replace(' ','-')}"
-    return Experts(
+def init_experts(
+    industry: str,
+    num_employees: int = NUM_EMPLOYEES,
+    num_products: int = MIN_PRODUCTS,
+    output_formats: Mapping[str, OutputFormat] | None = None,
+    expert_candidates: Mapping[str, int] | None = None,
+    warm_up: bool = False,
+    timesheet_mode: TimesheetMode = "llm",
+    **expert_options: Any,
+) -> Experts:
+    """Creates the experts for an industry, `expert_options` (e.g. `cache` or
+    `stream`) are passed to every expert. `output_formats` and
+    `expert_candidates` override the output format and number of speculative
+    candidates of experts by their name in `Experts`. Questions ask for at most a
+    page of employees or products, larger tables are generated a page at a time.
+
+    Experts asked about each employee (or job title) have the codes they can
+    use in their shared context, ahead of the employees, so each prompt starts
+    the same way. With `warm_up`, the experts' models are loaded before any
+    questions are asked. Only the timesheet expert that `timesheet_mode` uses is
+    created."""
+    name_prefix = f"user/{industry_slug(industry)}"
+
+    def options_for(expert: str) -> dict[str, Any]:
+        options = dict(expert_options)
+        if output_formats and expert in output_formats:
+            options["output_format"] = output_formats[expert]
+        if expert_candidates and expert in expert_candidates:
+            options["candidates"] = expert_candidates[expert]
+        return options
+
+    timesheet_data_entry = timesheet_planner = None
+    if timesheet_mode == "llm":
+        timesheet_data_entry = PolarsLLM(
+            name=f"{name_prefix}/timesheet-peon",
+            expertise=f"Filling in timesheets for employees in a {industry} company.",
+            schema=Timesheets,
+            reply_parser=lambda df: df.with_columns(
+                pl.col("employee_code").cast(pl.String),
+                pl.col("time_code").cast(pl.String),
+            ),
+            context=lambda time_code_csv: (
+                f"Only use time_codes from the following dataset: \n{time_code_csv}\n"
+                "If an employee works multiple time codes in one day, they should be on "
+                "separate rows. "
+                f"Do not produce more than {MAX_TIMESHEETS} rows per employee."
+            ),
+            questioner=lambda employees_csv: (
+                "Fill in 3 days of timesheets for each of the following employees, who "
+                f"work roughly their weekly_hours per week: \n{employees_csv}"
+            ),
+            tools=[get_number_of_hours_worked_for_day],
+            **options_for("timesheet_data_entry"),
+        )
+    else:
+        timesheet_planner = PolarsLLM(
+            name=f"{name_prefix}/timesheet-planner",
+            expertise=f"Rostering and timesheets for a {industry} company.",
+            schema=TimesheetPatterns,
+            reply_parser=lambda df: df.with_columns(
+                pl.col("time_code").cast(pl.String),
+                pl.col("share").cast(pl.Float64, strict=False),
+            ),
+            context=lambda time_code_csv: (
+                f"Only use time_codes from the following dataset: \n{time_code_csv}\n"
+                "The shares for each job title should add up to 1. Leave out the "
+                "weekdays a job title doesn't usually work."
+            ),
+            questioner=lambda job_titles: (
+                "For each of the following job titles, describe a typical week of "
+                "timesheets as the share of the week's hours spent on each time code "
+                "on each weekday:"
+                + str().join(f"\n    - {job_title}" for job_title in job_titles)
+            ),
+            **options_for("timesheet_planner"),
+        )
+
+    experts = Experts(
         hr=PolarsLLM(
             name=f"{name_prefix}/hr",
             expertise=f"{industry.title()} and HR data",
             schema=HR,
             reply_parser=lambda df: df.with_columns(pl.col("hire_date").str.to_date()),
-            questioner=f"Generate data for {NUM_EMPLOYEES} employees for a {industry} company",
+            questioner=f"Generate data for {min(num_employees, EMPLOYEES_PER_PAGE)} employees for a {industry} company",
+            **options_for("hr"),
         ),
         payroll_admin=PolarsLLM(
             name=f"{name_prefix}/payroll-admin",
@@ -159,6 +324,7 @@ def init_experts(industry: str) -> Experts:
                 "overtime, and holiday rates. Different leave types should use different pay codes. "
                 f"There should be at least {MIN_UNIQUE_PAYCODES} different paycodes."
             ),
+            **options_for("payroll_admin"),
         ),
         timesheet_admin=PolarsLLM(
             name=f"{name_prefix}/timesheet-admin",
@@ -173,40 +339,31 @@ def init_experts(industry: str) -> Experts:
                 f"There should be at least {MIN_UNIQUE_TIMECODES} different time codes. "
                 "time_code should be short and unique."
             ),
+            **options_for("timesheet_admin"),
         ),
-        timesheet_data_entry=PolarsLLM(
-            name=f"{name_prefix}/timesheet-peon",
-            expertise=f"Filling in timesheets for employees in a {industry} company.",
-            schema=Timesheets,
-            reply_parser=lambda df: df.with_columns(
-                pl.col("time_code").cast(pl.String)
-            ),
-            questioner=lambda job_title, time_code_csv, weekly_hours: (
-                f"Fill in 3 days of timesheets for a {job_title} who works roughly "
-                f"{weekly_hours} per week. "
-                f"Only use time_codes from the following dataset: \n{time_code_csv}\n"
-                "If an employee works multiple time codes in one day, they should be on "
-                "separate rows. "
-                f"Do not produce more than {MAX_TIMESHEETS} rows."
-            ),
-            tools=[get_number_of_hours_worked_for_day],
-        ),
+        timesheet_data_entry=timesheet_data_entry,
+        timesheet_planner=timesheet_planner,
         payroll_data_entry=PolarsLLM(
             name=f"{name_prefix}/payroll-peon",
             expertise=f"Payroll and {industry.title()}",
             schema=Payroll,
             reply_parser=lambda df: df.with_columns(
+                pl.col("employee_code").cast(pl.String),
                 pl.col("pay_code").str.to_uppercase(),
                 pl.col("hours").cast(pl.Float64, strict=False),
                 pl.col("amount").cast(pl.Float64, strict=False),
             ),
-            questioner=lambda contract_type, job_title, weekly_hours, paycode_csv: (
-                f"Generate one week's worth of payroll data for a {contract_type} {job_title} "
-                f"who works {weekly_hours} hours per week. "
+            context=lambda paycode_csv: (
                 f"Only use pay_codes from the following dataset:\n{paycode_csv}\n"
-                "Avoid having multiple rows with the same 'pay_code' or 'amount' values"
+                "Avoid having multiple rows for one employee with the same 'pay_code' "
+                "or 'amount' values"
+            ),
+            questioner=lambda employees_csv: (
+                "Generate one week's worth of payroll data for each of the following "
+                f"employees, who work their weekly_hours per week:\n{employees_csv}"
             ),
             tools=[get_typical_monthly_salary_for_job_title],
+            **options_for("payroll_data_entry"),
         ),
         product_expert=PolarsLLM(
             name=f"{name_prefix}/product",
@@ -217,69 +374,404 @@ def init_experts(industry: str) -> Experts:
                 "website and eBay store. It should have a good mix of different items, styles "
                 " and themes. The 'product_description' field should be kept to one sentence. "
                 "Each product_category should have more than one product. "
-                f"Generate at least {MIN_PRODUCTS} different products."
+                f"Generate at least {min(num_products, PRODUCTS_PER_PAGE)} different products."
             ),
+            **options_for("product_expert"),
         ),
     )
+    if warm_up:
+        client_pool.warm_up(
+            list(
+                dict.fromkeys(
+                    expert.ollama_model for expert in experts if expert is not None
+                )
+            ),
+            keep_alive=expert_options.get("keep_alive"),
+        )
+
+    return experts
 
 
-def generate_data(experts: Experts) -> GeneratedData:
+def generate_hr(
+    expert: PolarsLLM,
+    num_employees: int = NUM_EMPLOYEES,
+    table_dir: Path | None = None,
+) -> DataFrame[HR]:
+    """Employees are generated a page at a time if there are more than fit on a
+    page, or they are being saved to `table_dir`"""
     logger.info("generating hr...")
-    hr = experts.hr.generate_data().with_columns(
+    if num_employees <= EMPLOYEES_PER_PAGE and table_dir is None:
+        hr = expert.fork().generate_data()
+    else:
+        hr = generate_table(
+            expert,
+            total_rows=num_employees,
+            key_columns=["employee_code"],
+            directory=table_dir and table_dir / "hr",
+        ).collect()
+
+    return hr.with_columns(
         pl.col("fte").mul(FTE_HOURS_PER_WEEK).alias("weekly_hours")
     )
 
+
+def generate_timesheet_codes(
+    expert: PolarsLLM, hr: DataFrame[HR]
+) -> DataFrame[TimesheetCodes]:
     logger.info("generating timesheet_codes...")
-    timesheet_codes = experts.timesheet_admin.generate_data(job_titles=hr["job_title"])
+    return expert.fork().generate_data(
+        job_titles=hr["job_title"].unique(maintain_order=True)
+    )
+
+
+def generate_for_employees(
+    expert: PolarsLLM,
+    hr: DataFrame[HR],
+    employee_cols: list[str],
+    max_concurrency: int = DEFAULT_CONCURRENCY,
+    employees_per_prompt: int = EMPLOYEES_PER_PROMPT,
+    parts: Parts | None = None,
+    **context: Any,
+) -> pl.DataFrame:
+    """Asks `expert` about `employees_per_prompt` employees at a time, passing
+    their `employee_cols` to the questioner as `employees_csv`. Rows for
+    employees that weren't asked about are dropped, and employees missing from
+    the replies are asked about again. `context` fills in the expert's shared
+    context, which comes before the employees in every prompt.
+
+    Each batch's rows are saved to `parts` as soon as they're generated, and
+    employees with saved rows aren't asked about again."""
+    expert = expert.with_context(**context)
+    remaining = hr
+    dfs: list[pl.DataFrame] = []
+    saved = parts.load() if parts is not None else None
+    if saved is not None:
+        logger.info(f"loaded rows for {saved['employee_code'].n_unique()} employees")
+        dfs.append(saved)
+        remaining = remaining.filter(
+            ~pl.col("employee_code").is_in(saved["employee_code"])
+        )
+        if remaining.is_empty():
+            return saved
+
+    for _ in range(MAX_EMPLOYEE_ROUNDS):
+        batches = list(remaining.iter_slices(employees_per_prompt))
+        known_rows: dict[int, pl.DataFrame] = {}
+
+        def keep_known(index: int, reply: pl.DataFrame) -> None:
+            batch = batches[index]
+            known = reply.filter(pl.col("employee_code").is_in(batch["employee_code"]))
+            if known.height < reply.height:
+                logger.warning(
+                    f"{expert} dropped {reply.height - known.height} rows for unknown employees"
+                )
+            known_rows[index] = known
+            if parts is not None and not known.is_empty():
+                parts.save(known)
+
+        expert.generate_data_concurrently(
+            [
+                dict(employees_csv=batch[["employee_code", *employee_cols]].write_csv())
+                for batch in batches
+            ],
+            max_concurrency=max_concurrency,
+            on_result=keep_known,
+            # only trust the model's employee codes when it's asked about several
+            filled=[
+                dict(employee_code=batch["employee_code"][0])
+                if batch.height == 1
+                else {}
+                for batch in batches
+            ],
+        )
+        dfs.extend(known_rows[index] for index in sorted(known_rows))
+
+        generated = pl.concat(dfs)
+        remaining = remaining.filter(
+            ~pl.col("employee_code").is_in(generated["employee_code"])
+        )
+        if remaining.is_empty():
+            return generated
+
+        logger.warning(
+            f"{expert} missed employees {remaining['employee_code'].to_list()}, asking again"
+        )
 
+    raise Exception(
+        f"Could not generate data for employees {remaining['employee_code'].to_list()}"
+    )
+
+
+def generate_timesheets(
+    expert: PolarsLLM,
+    hr: DataFrame[HR],
+    timesheet_codes: DataFrame[TimesheetCodes],
+    max_concurrency: int = DEFAULT_CONCURRENCY,
+    employees_per_prompt: int = EMPLOYEES_PER_PROMPT,
+    checkpoints: Checkpoints | None = None,
+) -> DataFrame[Timesheets]:
     logger.info("generating timesheets...")
-    timesheet_dfs = [
-        (
-            experts.timesheet_data_entry.generate_data(
-                start_new_conversation=True,
-                job_title=row["job_title"],
-                weekly_hours=row["weekly_hours"],
-                time_code_csv=timesheet_codes[
-                    ["time_code", "time_code_description"]
-                ].write_csv(),
-            ).with_columns(pl.lit(row["employee_code"]).alias("employee_code"))
+    timesheets = generate_for_employees(
+        expert,
+        hr,
+        employee_cols=["job_title", "weekly_hours"],
+        max_concurrency=max_concurrency,
+        employees_per_prompt=employees_per_prompt,
+        parts=checkpoints and checkpoints.parts("timesheets"),
+        time_code_csv=timesheet_codes[
+            ["time_code", "time_code_description"]
+        ].write_csv(),
+    )
+    logger.info(timesheets)
+    return timesheets
+
+
+def generate_timesheet_patterns(
+    expert: PolarsLLM,
+    hr: DataFrame[HR],
+    timesheet_codes: DataFrame[TimesheetCodes],
+    max_concurrency: int = DEFAULT_CONCURRENCY,
+    job_titles_per_prompt: int = JOB_TITLES_PER_PROMPT,
+) -> DataFrame[TimesheetPatterns]:
+    """Asks for the weekly pattern of `job_titles_per_prompt` job titles at a time,
+    asking again about job titles missing from the replies. Rows for other job
+    titles, or unknown time codes, are dropped."""
+    logger.info("generating timesheet_patterns...")
+    expert = expert.with_context(
+        time_code_csv=timesheet_codes[["time_code", "time_code_description"]].write_csv()
+    )
+    remaining = hr["job_title"].unique(maintain_order=True)
+    dfs: list[pl.DataFrame] = []
+
+    for _ in range(MAX_EMPLOYEE_ROUNDS):
+        replies = expert.generate_data_concurrently(
+            [
+                dict(job_titles=remaining.slice(offset, job_titles_per_prompt).to_list())
+                for offset in range(0, remaining.len(), job_titles_per_prompt)
+            ],
+            max_concurrency=max_concurrency,
         )
-        for row in hr.rows(named=True)
-    ]
-    timesheets = pl.concat(timesheet_dfs)
+        reply = pl.concat(replies)
+        known = reply.filter(
+            pl.col("job_title").is_in(remaining)
+            & pl.col("time_code").is_in(timesheet_codes["time_code"])
+        )
+        if known.height < reply.height:
+            logger.warning(
+                f"{expert} dropped {reply.height - known.height} rows for unknown "
+                "job titles or time codes"
+            )
+        dfs.append(known)
+
+        remaining = remaining.filter(~remaining.is_in(known["job_title"]))
+        if remaining.is_empty():
+            patterns = pl.concat(dfs)
+            logger.info(patterns)
+            return patterns
+
+        logger.warning(
+            f"{expert} missed job titles {remaining.to_list()}, asking again"
+        )
+
+    raise Exception(f"Could not generate patterns for job titles {remaining.to_list()}")
+
+
+def expand_timesheets(
+    hr: DataFrame[HR],
+    timesheet_patterns: DataFrame[TimesheetPatterns],
+    start: date | None = None,
+    num_weeks: int = TIMESHEET_WEEKS,
+) -> DataFrame[Timesheets]:
+    """Timesheets with a `date`, for `num_weeks` weeks of every employee's job
+    title's pattern"""
+    logger.info(f"expanding {num_weeks} weeks of timesheets...")
+    timesheets = validate(
+        expand_timesheet_patterns(
+            hr, timesheet_patterns, start=start, num_weeks=num_weeks
+        ),
+        compile_schema(Timesheets),
+    )
     logger.info(timesheets)
+    return timesheets
 
+
+def generate_payroll_definitions(expert: PolarsLLM) -> DataFrame[PayrollDefinitions]:
     logger.info("generating payroll_definitions...")
-    payroll_definitions = experts.payroll_admin.generate_data()
+    return expert.fork().generate_data()
+
 
+def generate_payroll(
+    expert: PolarsLLM,
+    hr: DataFrame[HR],
+    payroll_definitions: DataFrame[PayrollDefinitions],
+    max_concurrency: int = DEFAULT_CONCURRENCY,
+    employees_per_prompt: int = EMPLOYEES_PER_PROMPT,
+    checkpoints: Checkpoints | None = None,
+) -> DataFrame[Payroll]:
     logger.info("generating payroll...")
-    payroll_dfs = [
-        (
-            experts.payroll_data_entry.generate_data(
-                start_new_conversation=True,
-                contract_type=row["contract_type"],
-                job_title=row["job_title"],
-                weekly_hours=row["weekly_hours"],
-                paycode_csv=payroll_definitions[
-                    ["pay_code", "pay_code_description"]
-                ].write_csv(),
-            ).with_columns(
-                pl.lit(row["employee_code"]).alias("employee_code"),
-            )
-        )
-        for row in hr.rows(named=True)
-    ]
-    payroll = pl.concat(payroll_dfs)
+    payroll = generate_for_employees(
+        expert,
+        hr,
+        employee_cols=["contract_type", "job_title", "weekly_hours"],
+        max_concurrency=max_concurrency,
+        employees_per_prompt=employees_per_prompt,
+        parts=checkpoints and checkpoints.parts("payroll"),
+        paycode_csv=payroll_definitions[
+            ["pay_code", "pay_code_description"]
+        ].write_csv(),
+    )
     logger.info(payroll)
+    return payroll
+
 
+def generate_products(
+    expert: PolarsLLM,
+    num_products: int = MIN_PRODUCTS,
+    table_dir: Path | None = None,
+) -> DataFrame[ProductLine]:
     logger.info("generating products...")
-    products = experts.product_expert.generate_data()
+    if num_products <= PRODUCTS_PER_PAGE and table_dir is None:
+        return expert.fork().generate_data()
+
+    return generate_table(
+        expert,
+        total_rows=num_products,
+        key_columns=["product_name"],
+        directory=table_dir and table_dir / "products",
+    ).collect()
+
+
+def make_stages(
+    experts: Experts,
+    max_concurrency: int = DEFAULT_CONCURRENCY,
+    employees_per_prompt: int = EMPLOYEES_PER_PROMPT,
+    num_employees: int = NUM_EMPLOYEES,
+    num_products: int = MIN_PRODUCTS,
+    table_dir: Path | None = None,
+    checkpoints: Checkpoints | None = None,
+    timesheet_mode: TimesheetMode = "llm",
+    timesheet_weeks: int = TIMESHEET_WEEKS,
+) -> list[Stage]:
+    """The stages needed to generate each field of `GeneratedData`, and which
+    other stages they depend on. Large tables are saved to `table_dir` a page at
+    a time, if it is given. With `checkpoints`, finished stages are loaded rather
+    than generated again, and new results are saved.
+
+    In the "patterns" `timesheet_mode`, timesheets are expanded from a weekly
+    pattern per job title (an extra "timesheet_patterns" stage) for
+    `timesheet_weeks` weeks, rather than generated for each employee.
+
+    Experts are forked within each stage, so that stages running at the same
+    time never share a conversation. They must have been created for the same
+    `timesheet_mode`.
+    """
+    if timesheet_mode == "patterns":
+        timesheet_stages = [
+            Stage(
+                "timesheet_patterns",
+                ("hr", "timesheet_codes"),
+                partial(
+                    generate_timesheet_patterns,
+                    experts.timesheet_planner,
+                    max_concurrency=max_concurrency,
+                ),
+            ),
+            Stage(
+                "timesheets",
+                ("hr", "timesheet_patterns"),
+                partial(expand_timesheets, num_weeks=timesheet_weeks),
+            ),
+        ]
+    else:
+        timesheet_stages = [
+            Stage(
+                "timesheets",
+                ("hr", "timesheet_codes"),
+                partial(
+                    generate_timesheets,
+                    experts.timesheet_data_entry,
+                    max_concurrency=max_concurrency,
+                    employees_per_prompt=employees_per_prompt,
+                    checkpoints=checkpoints,
+                ),
+            )
+        ]
 
+    stages = [
+        Stage(
+            "hr",
+            (),
+            partial(
+                generate_hr,
+                experts.hr,
+                num_employees=num_employees,
+                table_dir=table_dir,
+            ),
+        ),
+        Stage(
+            "timesheet_codes",
+            ("hr",),
+            partial(generate_timesheet_codes, experts.timesheet_admin),
+        ),
+        *timesheet_stages,
+        Stage(
+            "payroll_definitions",
+            (),
+            partial(generate_payroll_definitions, experts.payroll_admin),
+        ),
+        Stage(
+            "payroll",
+            ("hr", "payroll_definitions"),
+            partial(
+                generate_payroll,
+                experts.payroll_data_entry,
+                max_concurrency=max_concurrency,
+                employees_per_prompt=employees_per_prompt,
+                checkpoints=checkpoints,
+            ),
+        ),
+        Stage(
+            "products",
+            (),
+            partial(
+                generate_products,
+                experts.product_expert,
+                num_products=num_products,
+                table_dir=table_dir,
+            ),
+        ),
+    ]
+    if checkpoints is None:
+        return stages
+
+    return [checkpoint_stage(stage, checkpoints) for stage in stages]
+
+
+def generate_data(
+    experts: Experts,
+    max_concurrency: int = DEFAULT_CONCURRENCY,
+    employees_per_prompt: int = EMPLOYEES_PER_PROMPT,
+    num_employees: int = NUM_EMPLOYEES,
+    num_products: int = MIN_PRODUCTS,
+    table_dir: Path | None = None,
+    checkpoints: Checkpoints | None = None,
+    timesheet_mode: TimesheetMode = "llm",
+    timesheet_weeks: int = TIMESHEET_WEEKS,
+) -> GeneratedData:
+    schedule = run_stages(
+        make_stages(
+            experts,
+            max_concurrency=max_concurrency,
+            employees_per_prompt=employees_per_prompt,
+            num_employees=num_employees,
+            num_products=num_products,
+            table_dir=table_dir,
+            checkpoints=checkpoints,
+            timesheet_mode=timesheet_mode,
+            timesheet_weeks=timesheet_weeks,
+        )
+    )
+    # timesheet_patterns is only a step towards timesheets
     return GeneratedData(
-        hr=hr,
-        payroll_definitions=payroll_definitions,
-        timesheet_codes=timesheet_codes,
-        timesheets=timesheets,
-        payroll=payroll,
-        products=products,
+        **{name: schedule.results[name] for name in GeneratedData._fields}
     )
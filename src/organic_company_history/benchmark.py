@@ -0,0 +1,676 @@
+"""python -m organic_company_history.benchmark
+
+Benchmarks for the parts of generating data that aren't the LLM itself.
+
+`imports` times starting up. `e2e` generates data against a local stand-in for
+the ollama server (or several), which replies instantly (or after a fixed latency) with
+scripted or recorded replies, so orchestration, parsing and database overhead
+can be measured without a model.
+"""
+from __future__ import annotations
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import random
+import re
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Sequence
+
+IMPORT_MODULES = (
+    "organic_company_history.main",
+    "organic_company_history.database",
+    "organic_company_history.polars_llm",
+    "organic_company_history.basis",
+)
+
+DEFAULT_REPEATS = 5
+
+SCRIPTED_ROWS = 8
+"""Rows in scripted replies, unless the question asks for a number of employees"""
+
+ROWS_PER_EMPLOYEE = 2
+"""Rows per employee in scripted replies to questions about a list of employees"""
+
+PROMPT_SLOTS = 4
+"""Recent prompts per model that a fake server can reuse the evaluation of, like
+ollama's parallel slots"""
+
+TOOL_CALLS_PER_MESSAGE = 3
+"""Calls in a scripted message that calls tools, e.g. one for each of a few days"""
+
+WEEKDAYS = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday")
+
+Reply = Callable[
+    [str, list[dict[str, Any]], list[dict[str, Any]], Any], dict[str, Any]
+]
+"""Makes the reply message for a (system message, messages, tools, format) request"""
+
+
+def time_command(args: list[str], repeats: int = DEFAULT_REPEATS) -> float:
+    """Fastest wall time (in seconds) of running a command in a fresh interpreter"""
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, *args], check=True, capture_output=True)
+        timings.append(time.perf_counter() - started)
+
+    return min(timings)
+
+
+def benchmark_imports(repeats: int = DEFAULT_REPEATS) -> dict[str, float]:
+    """Time taken to start python and import each module, and to show the cli help"""
+    timings = {"python": time_command(["-c", "pass"], repeats=repeats)}
+    for module in IMPORT_MODULES:
+        timings[module] = time_command(["-c", f"import {module}"], repeats=repeats)
+
+    timings["main --help"] = time_command(
+        ["-m", "organic_company_history.main", "--help"], repeats=repeats
+    )
+    return timings
+
+
+def print_timings(timings: dict[str, float]) -> None:
+    width = max(len(name) for name in timings)
+    for name, seconds in timings.items():
+        print(f"{name:<{width}}  {seconds * 1000:8.1f}ms")
+
+
+def parse_fields(system_message: str) -> list[tuple[str, str]]:
+    """The (name, type) of each field an expert's system message asks for"""
+    fields = system_message.partition("The fields and data types required are: ")[2]
+    # anything after the fields is the expert's shared context
+    fields = fields.partition("\n")[0]
+    return [
+        tuple(field.strip().split("=", 1))  # type: ignore[misc]
+        for field in fields.split(";")
+        if "=" in field
+    ]
+
+
+def scripted_value(name: str, dtype: str, row: int) -> str:
+    if name == "weekday":
+        return WEEKDAYS[row % len(WEEKDAYS)]
+    if dtype == "float":
+        return f"{row + 1}.5"
+    if dtype in ("int", "integer"):
+        return str(row + 1)
+    if dtype in ("datetime", "date", "timestamp"):
+        return f"2020-01-{row % 28 + 1:02d}"
+    return f"{name} {row}"
+
+
+def scripted_rows(system_message: str, question: str) -> list[dict[str, str]]:
+    """Valid rows for the fields in `system_message`, with rows for each employee
+    (or job title) for questions about employees (or job titles)"""
+    fields = parse_fields(system_message)
+    names = [name for name, _ in fields]
+
+    listed = re.findall(r"^(E\d+),", question, re.M)
+    job_titles = re.findall(r"^    - (job_title \d+)$", question, re.M)
+    asked_for = re.search(r"Generate data for (\d+) employees", question)
+    # carrying on from earlier pages of a table
+    done = re.search(r"(\d+) rows have already been generated", question)
+    offset = int(done.group(1)) if done else 0
+
+    if listed and "employee_code" in names:
+        codes = [code for code in listed for _ in range(ROWS_PER_EMPLOYEE)]
+        indexes = [i % ROWS_PER_EMPLOYEE for i in range(len(codes))]
+    else:
+        num_rows = int(asked_for.group(1)) if asked_for else SCRIPTED_ROWS
+        indexes = list(range(offset, offset + num_rows))
+        codes = [f"E{i}" for i in indexes]
+
+    if job_titles and "job_title" in names:
+        # a weekly pattern for each job title
+        return [
+            {
+                name: job_title if name == "job_title" else scripted_value(name, dtype, i)
+                for name, dtype in fields
+            }
+            for job_title in job_titles
+            for i in range(ROWS_PER_EMPLOYEE)
+        ]
+
+    return [
+        {
+            name: code if name == "employee_code" else scripted_value(name, dtype, i)
+            for name, dtype in fields
+        }
+        for code, i in zip(codes, indexes)
+    ]
+
+
+def scripted_csv(system_message: str, question: str) -> str:
+    rows = scripted_rows(system_message, question)
+    names = [name for name, _ in parse_fields(system_message)]
+    return "\n".join([",".join(names), *(",".join(row.values()) for row in rows)])
+
+
+def scripted_json(system_message: str, question: str) -> str:
+    """Rows as a json object, with numbers for numeric fields"""
+    dtypes = dict(parse_fields(system_message))
+    rows = [
+        {
+            name: float(value) if dtypes[name] == "float" else value
+            for name, value in row.items()
+        }
+        for row in scripted_rows(system_message, question)
+    ]
+    return json.dumps({"rows": rows})
+
+
+def malform(csv: str, rng: random.Random) -> str:
+    """Breaks a csv in one of the ways LLMs tend to"""
+    header, _, body = csv.partition("\n")
+    defect = rng.choice(["header", "leading_comma", "ragged", "prose"])
+    if defect == "header":
+        return header.rsplit(",", 1)[0] + "\n" + body
+    if defect == "leading_comma":
+        return header + "\n" + "\n".join("," + line for line in body.splitlines())
+    if defect == "ragged":
+        return csv + ",extra,values"
+    return "Sure! Here is the data you asked for.\n\n" + csv + "\n\nLet me know!"
+
+
+class ScriptedReplies:
+    """Replies with valid csvs built from each expert's system message, with some
+    replies malformed or calling tools"""
+
+    def __init__(
+        self, malformed_rate: float = 0.0, tool_call_rate: float = 0.0, seed: int = 0
+    ) -> None:
+        self.malformed_rate = malformed_rate
+        self.tool_call_rate = tool_call_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def __call__(
+        self,
+        system: str,
+        messages: list[dict[str, Any]],
+        tools: list[dict[str, Any]],
+        format: Any = "",
+    ) -> dict[str, Any]:
+        question = next(m["content"] for m in messages if m["role"] == "user")
+
+        with self._lock:
+            call_tool = self._rng.random() < self.tool_call_rate
+            malformed = self._rng.random() < self.malformed_rate
+            rng = random.Random(self._rng.random())
+
+        if tools and call_tool and messages[-1]["role"] == "user":
+            function = tools[0]["function"]
+            properties = function["parameters"]["properties"]
+            return {
+                "role": "assistant",
+                "content": "",
+                "tool_calls": [
+                    {
+                        "function": {
+                            "name": function["name"],
+                            "arguments": {
+                                name: scripted_value(name, spec["type"], i)
+                                for name, spec in properties.items()
+                            },
+                        }
+                    }
+                    for i in range(TOOL_CALLS_PER_MESSAGE)
+                ],
+            }
+
+        if isinstance(format, dict):
+            # ollama constrains json replies to the schema, so they aren't malformed
+            return {"role": "assistant", "content": scripted_json(system, question)}
+
+        csv = scripted_csv(system, question)
+        return {"role": "assistant", "content": malform(csv, rng) if malformed else csv}
+
+
+class RecordedReplies:
+    """Replays the replies recorded in a conversation database, matched on the
+    message they replied to. Falls back to `fallback` for unrecorded messages."""
+
+    def __init__(self, db_path: str, fallback: Reply) -> None:
+        self.fallback = fallback
+        self.replies: dict[str, str] = {}
+        with sqlite3.connect(db_path) as connection:
+            rows = connection.execute(
+                "select conversation_id, role, content from messages "
+                "order by conversation_id, id"
+            ).fetchall()
+
+        previous: tuple[int, str, str] | None = None
+        for row in rows:
+            if previous and previous[0] == row[0] and row[1] == "assistant":
+                self.replies.setdefault(previous[2], row[2])
+            previous = row
+
+    def __call__(
+        self,
+        system: str,
+        messages: list[dict[str, Any]],
+        tools: list[dict[str, Any]],
+        format: Any = "",
+    ) -> dict[str, Any]:
+        content = self.replies.get(messages[-1]["content"])
+        if content is None:
+            return self.fallback(system, messages, tools, format)
+        return {"role": "assistant", "content": content}
+
+
+class FakeOllamaServer:
+    """A local http server that answers the ollama api calls PolarsLLM makes"""
+
+    def __init__(self, reply: Reply, latency: float = 0.0, port: int = 0) -> None:
+        self.reply = reply
+        self.latency = latency
+        self.models: dict[str, str] = {}
+        """System message of each created model"""
+        self.prompts: dict[str, list[str]] = {}
+        """The latest prompts sent to each model, whose evaluation can be reused"""
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread: threading.Thread | None = None
+
+    @property
+    def host(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self) -> FakeOllamaServer:
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def chat(self, request: dict[str, Any]) -> list[dict[str, Any]]:
+        """The chunks of a response, just one unless streaming"""
+        with self._lock:
+            self.requests += 1
+
+        started = time.perf_counter_ns()
+        messages = request["messages"]
+        if not messages:
+            # ollama loads the model, and replies without a message
+            return [
+                {
+                    "model": request["model"],
+                    "created_at": datetime.now(timezone.utc).isoformat(),
+                    "message": {"role": "assistant", "content": ""},
+                    "done": True,
+                    "done_reason": "load",
+                }
+            ]
+
+        system = next(
+            (m["content"] for m in messages if m["role"] == "system"),
+            self.models.get(request["model"], ""),
+        )
+        message = self.reply(
+            system, messages, request.get("tools") or [], request.get("format")
+        )
+        time.sleep(self.latency)
+
+        content = message["content"]
+        duration = time.perf_counter_ns() - started
+        prompt_tokens = self.evaluate_prompt(
+            request["model"],
+            system + "".join(m["content"] for m in messages if m["role"] != "system"),
+        )
+        done = {
+            "model": request["model"],
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "message": message,
+            "done": True,
+            "done_reason": "stop",
+            "total_duration": duration,
+            "load_duration": 0,
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": duration // 4,
+            "eval_count": len(content) // 4,
+            "eval_duration": duration - duration // 4,
+        }
+        if not request.get("stream"):
+            return [done]
+
+        chunks = [
+            {
+                "model": request["model"],
+                "message": {"role": "assistant", "content": content[i : i + 16]},
+                "done": False,
+            }
+            for i in range(0, len(content), 16)
+        ]
+        return [*chunks, {**done, "message": {**message, "content": ""}}]
+
+    def evaluate_prompt(self, model: str, prompt: str) -> int:
+        """Tokens of `prompt` that have to be evaluated, like ollama, only those
+        after the longest start it shares with one of the model's recent prompts"""
+        with self._lock:
+            recent = self.prompts.setdefault(model, [])
+            reused = max(
+                (len(os.path.commonprefix([prompt, other])) for other in recent),
+                default=0,
+            )
+            recent.append(prompt)
+            del recent[:-PROMPT_SLOTS]
+
+        return (len(prompt) - reused) // 4
+
+    def _make_handler(self) -> type[BaseHTTPRequestHandler]:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args) -> None:
+                pass
+
+            def send_json_lines(self, lines: list[dict[str, Any]]) -> None:
+                body = "\n".join(json.dumps(line) for line in lines).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self) -> None:
+                if self.path == "/api/tags":
+                    models = [{"name": name, "model": name} for name in server.models]
+                    return self.send_json_lines([{"models": models}])
+                self.send_error(404)
+
+            def do_POST(self) -> None:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+
+                if self.path == "/api/chat":
+                    return self.send_json_lines(server.chat(request))
+
+                if self.path == "/api/create":
+                    name = request.get("name") or request.get("model")
+                    system = request.get("modelfile", "").partition("SYSTEM ")[2]
+                    server.models[name] = system.strip()
+                    return self.send_json_lines([{"status": "success"}])
+
+                self.send_error(404)
+
+        return Handler
+
+
+def benchmark_generation(
+    num_industries: int,
+    num_employees: int,
+    expert_options: dict[str, Any] | None = None,
+    **options: Any,
+) -> dict[str, Any]:
+    """Generates data for `num_industries` made up industries, returning timings.
+    `expert_options` are passed to every expert, `options` to `make_stages`.
+    Expects OLLAMA_HOSTS to point at fake servers."""
+    from . import database, report
+    from .basis import init_experts, make_stages
+    from .scheduler import Schedule, run_stages
+
+    started = time.perf_counter()
+    schedules: list[Schedule] = []
+    rows = 0
+    for i in range(num_industries):
+        industry = f"benchmark industry {i}"
+        run_id = database.writer.insert(database.Run, label=industry)
+        token = database.current_run_id.set(run_id)
+        try:
+            experts = init_experts(
+                industry,
+                num_employees=num_employees,
+                timesheet_mode=options.get("timesheet_mode", "llm"),
+                **(expert_options or {}),
+            )
+            schedule = run_stages(
+                make_stages(experts, num_employees=num_employees, **options)
+            )
+        finally:
+            database.current_run_id.reset(token)
+        schedules.append(schedule)
+        rows += sum(df.height for df in schedule.results.values())
+
+    generated = time.perf_counter()
+    database.writer.flush()
+    flushed = time.perf_counter()
+
+    responses = report.load_responses()
+    by_stage = report.summarise(responses, by="stage")
+
+    return {
+        "industries": num_industries,
+        "employees": num_employees,
+        "seconds": generated - started,
+        "rows": rows,
+        "rows_per_second": rows / (generated - started),
+        "responses": responses.height,
+        "retries": int(by_stage["retries"].sum()),
+        "prompt_tokens": int(by_stage["prompt_tokens"].sum()),
+        "reused_prompt_tokens": int(by_stage["reused_prompt_tokens"].sum()),
+        "restarts": int((responses["attempt"] > 0).sum()),
+        "stage_seconds": {
+            name: sum(s.timings[name].duration for s in schedules) / len(schedules)
+            for name in schedules[0].timings
+        },
+        "stage_model_seconds": dict(
+            zip(by_stage["stage"], by_stage["total_seconds"] / num_industries)
+        ),
+        "db_rows": database.writer.rows_written,
+        "db_write_seconds": database.writer.write_seconds,
+        "db_final_flush_seconds": flushed - generated,
+    }
+
+
+def benchmark_e2e(
+    industries: list[int],
+    employees: list[int],
+    reply: Reply,
+    latency: float = 0.0,
+    output_formats: Sequence[str] = ("csv",),
+    servers: int = 1,
+    candidates: int = 1,
+    **options: Any,
+) -> list[dict[str, Any]]:
+    """Runs `benchmark_generation` in a fresh process (and database) for every
+    combination of industries, employees and output format, spreading requests
+    over `servers` fake servers. Every expert races `candidates` conversations
+    for each question."""
+    results = []
+    scenarios = itertools.product(industries, employees, output_formats)
+    with contextlib.ExitStack() as stack:
+        fakes = [
+            stack.enter_context(FakeOllamaServer(reply, latency=latency))
+            for _ in range(servers)
+        ]
+        hosts = ",".join(fake.host for fake in fakes)
+        for num_industries, num_employees, output_format in scenarios:
+            requests_before = [fake.requests for fake in fakes]
+            output = subprocess.run(
+                [
+                    sys.executable,
+                    "-m",
+                    "organic_company_history.benchmark",
+                    "generation",
+                    "--industries",
+                    str(num_industries),
+                    "--employees",
+                    str(num_employees),
+                    "--options",
+                    json.dumps(options),
+                    "--expert-options",
+                    json.dumps(
+                        {"output_format": output_format, "candidates": candidates}
+                    ),
+                ],
+                env={**os.environ, "OLLAMA_HOSTS": hosts},
+                capture_output=True,
+                text=True,
+            )
+            if output.returncode:
+                raise RuntimeError(f"generation benchmark failed:\n{output.stderr}")
+            result = json.loads(output.stdout.strip().splitlines()[-1])
+            result["output_format"] = output_format
+            requests = [
+                fake.requests - before for fake, before in zip(fakes, requests_before)
+            ]
+            result["servers"] = servers
+            result["candidates"] = candidates
+            result["requests"] = sum(requests)
+            result["busiest_server_share"] = max(requests) / sum(requests)
+            result["requests_per_second"] = result["requests"] / result["seconds"]
+            results.append(result)
+
+    return results
+
+
+def print_e2e(results: list[dict[str, Any]]) -> None:
+    import polars as pl
+
+    summary = pl.DataFrame(
+        [
+            {
+                k: v
+                for k, v in result.items()
+                if k not in ("stage_seconds", "stage_model_seconds")
+            }
+            for result in results
+        ]
+    )
+    stages = pl.DataFrame(
+        [
+            {
+                "industries": result["industries"],
+                "employees": result["employees"],
+                "output_format": result["output_format"],
+                "stage": stage,
+                "seconds": seconds,
+                "model_seconds": result["stage_model_seconds"].get(stage, 0.0),
+            }
+            for result in results
+            for stage, seconds in result["stage_seconds"].items()
+        ]
+    ).with_columns(
+        (pl.col("seconds") - pl.col("model_seconds")).alias("overhead_seconds")
+    )
+
+    with pl.Config(
+        tbl_rows=-1, tbl_cols=-1, tbl_width_chars=240, float_precision=3
+    ):
+        print(summary)
+        print("per stage, averaged over industries:")
+        print(stages)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    imports_parser = subparsers.add_parser(
+        "imports", help="Time importing the package, and showing the cli help."
+    )
+    imports_parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS)
+
+    e2e_parser = subparsers.add_parser(
+        "e2e", help="Time generating data against a stand-in ollama server."
+    )
+    e2e_parser.add_argument("--industries", type=int, nargs="+", default=[1])
+    e2e_parser.add_argument("--employees", type=int, nargs="+", default=[5])
+    e2e_parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="Seconds the server takes to reply, 0 measures only overhead.",
+    )
+    e2e_parser.add_argument(
+        "--malformed", type=float, default=0.0, help="Share of malformed csv replies."
+    )
+    e2e_parser.add_argument(
+        "--tool-calls", type=float, default=0.0, help="Share of replies calling tools."
+    )
+    e2e_parser.add_argument(
+        "--replay", type=str, help="A conversation database to replay replies from."
+    )
+    e2e_parser.add_argument(
+        "--output-format",
+        choices=["csv", "json"],
+        nargs="+",
+        default=["csv"],
+        help="Output formats to compare.",
+    )
+    e2e_parser.add_argument(
+        "--servers", type=int, default=1, help="Fake servers to spread requests over."
+    )
+    e2e_parser.add_argument(
+        "--candidates", type=int, default=1, help="Conversations raced per question."
+    )
+    e2e_parser.add_argument("--concurrency", type=int)
+    e2e_parser.add_argument("--employees-per-prompt", type=int)
+    e2e_parser.add_argument("--timesheets", choices=["llm", "patterns"])
+
+    # run by e2e in a fresh process
+    generation_parser = subparsers.add_parser("generation")
+    generation_parser.add_argument("--industries", type=int, required=True)
+    generation_parser.add_argument("--employees", type=int, required=True)
+    generation_parser.add_argument("--options", type=json.loads, default={})
+    generation_parser.add_argument("--expert-options", type=json.loads, default={})
+
+    args = parser.parse_args()
+
+    if args.benchmark == "imports":
+        print_timings(benchmark_imports(repeats=args.repeats))
+
+    elif args.benchmark == "e2e":
+        reply: Reply = ScriptedReplies(
+            malformed_rate=args.malformed, tool_call_rate=args.tool_calls
+        )
+        if args.replay:
+            reply = RecordedReplies(args.replay, fallback=reply)
+
+        options = dict(
+            max_concurrency=args.concurrency,
+            employees_per_prompt=args.employees_per_prompt,
+            timesheet_mode=args.timesheets,
+        )
+        print_e2e(
+            benchmark_e2e(
+                industries=args.industries,
+                employees=args.employees,
+                reply=reply,
+                latency=args.latency,
+                output_formats=args.output_format,
+                servers=args.servers,
+                candidates=args.candidates,
+                **{name: value for name, value in options.items() if value is not None},
+            )
+        )
+
+    elif args.benchmark == "generation":
+        from . import database
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as directory:
+            database.configure(os.path.join(directory, "benchmark.db"))
+            result = benchmark_generation(
+                args.industries,
+                args.employees,
+                expert_options=args.expert_options,
+                **args.options,
+            )
+            database.writer.close()
+        print(json.dumps(result))
@@ -0,0 +1,262 @@
+"""Caching LLM responses and tool results in sqllite, so identical requests don't
+need to be re-generated"""
+from typing import Any, Callable, Mapping, Sequence, Type
+from datetime import datetime, timedelta
+import hashlib
+import json
+import threading
+from sqlalchemy.exc import IntegrityError
+from loguru import logger
+from . import database
+
+DEFAULT_CACHE_MAX_ENTRIES = 10_000
+"""Number of responses to keep before evicting the least recently used"""
+
+DEFAULT_CACHE_MAX_AGE = timedelta(days=30)
+"""Responses older than this are treated as a miss and evicted"""
+
+DEFAULT_TOOL_CACHE_MAX_ENTRIES = 100_000
+"""Number of tool results to keep before evicting the least recently used"""
+
+DEFAULT_TOOL_CACHE_MAX_AGE: timedelta | None = None
+"""Tool results older than this are treated as a miss and evicted, by default
+they're kept until they're the least recently used"""
+
+EVICT_EVERY = 100
+"""Puts between evictions. Evicting counts every row, so isn't done on every put,
+and caches can be over their `max_entries` by this many until the next eviction"""
+
+CachedRow = database.CachedResponse | database.CachedToolResult
+
+
+def make_cache_key(
+    base_model: str,
+    modelfile: str,
+    messages: Sequence[Mapping[str, Any]],
+    tools: Sequence[Mapping[str, Any]],
+    options: Mapping[str, Any] | None,
+) -> str:
+    """Hash of everything that can change the response of the LLM"""
+    payload = json.dumps(
+        {
+            "base_model": base_model,
+            "modelfile": modelfile,
+            "messages": messages,
+            "tools": tools,
+            "options": options,
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def make_tool_cache_key(tool: Callable, arguments: Mapping[str, Any]) -> str:
+    """Hash of the tool and the arguments it was called with"""
+    payload = json.dumps(
+        {
+            "tool": f"{tool.__module__}.{tool.__qualname__}",
+            "arguments": arguments,
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def evict(
+    table: Type[CachedRow], max_entries: int, max_age: timedelta | None
+) -> int:
+    """Removes rows of `table` older than `max_age`, then the least recently used
+    rows until there are at most `max_entries`. Returns the number evicted."""
+    session = database.get_session()
+    query = session.query(table)
+    evicted = 0
+
+    if max_age is not None:
+        evicted += query.filter(
+            table.created_at < datetime.utcnow() - max_age
+        ).delete()
+
+    excess = query.count() - max_entries
+    if excess > 0:
+        oldest = session.query(table.id).order_by(table.last_used_at).limit(excess)
+        evicted += query.filter(table.id.in_(oldest.scalar_subquery())).delete(
+            synchronize_session=False
+        )
+
+    session.commit()
+    if evicted:
+        logger.debug(f"evicted {evicted} rows from {table.__tablename__}")
+    return evicted
+
+
+class ResponseCache:
+    """Stores LLM responses in the database, evicting by age and number of entries."""
+
+    max_entries: int
+    max_age: timedelta | None
+    hits: int
+    misses: int
+    puts: int
+
+    def __init__(
+        self,
+        max_entries: int = DEFAULT_CACHE_MAX_ENTRIES,
+        max_age: timedelta | None = DEFAULT_CACHE_MAX_AGE,
+    ) -> None:
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"<ResponseCache(hits={self.hits}, misses={self.misses})>"
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, key: str) -> Mapping[str, Any] | None:
+        session = database.get_session()
+        cached = session.query(database.CachedResponse).filter_by(key=key).first()
+
+        if cached is not None and self.is_expired(cached):
+            session.delete(cached)
+            session.commit()
+            cached = None
+
+        with self._lock:
+            if cached is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        cached.last_used_at = datetime.utcnow()
+        session.commit()
+        logger.debug(f"cache hit for {key=}")
+        return cached.response
+
+    def put(self, key: str, response: Mapping[str, Any]) -> None:
+        session = database.get_session()
+        session.add(
+            database.CachedResponse(
+                key=key,
+                response=json.loads(json.dumps(response, default=str)),
+            )
+        )
+        try:
+            session.commit()
+        except IntegrityError:
+            # another conversation cached the same request first
+            session.rollback()
+            return None
+
+        self.evict_if_due()
+        return None
+
+    def discard(self, key: str) -> None:
+        """Removes a cached response, e.g. one that turned out to be invalid"""
+        session = database.get_session()
+        session.query(database.CachedResponse).filter_by(key=key).delete()
+        session.commit()
+
+    def evict_if_due(self) -> None:
+        with self._lock:
+            self.puts += 1
+            due = self.puts % EVICT_EVERY == 0
+        if due:
+            self.evict()
+
+    def is_expired(self, cached: database.CachedResponse) -> bool:
+        if self.max_age is None:
+            return False
+        return cached.created_at < datetime.utcnow() - self.max_age
+
+    def evict(self) -> int:
+        """Removes expired responses, then the least recently used responses
+        until there are at most `max_entries`. Returns the number evicted."""
+        return evict(database.CachedResponse, self.max_entries, self.max_age)
+
+
+class ToolCache:
+    """Stores the results of tool calls in the database, so a tool called with the
+    same arguments (in this run, or a later one) isn't run again. Only successful
+    calls are stored. Evicts by age and number of entries."""
+
+    max_entries: int
+    max_age: timedelta | None
+    hits: int
+    misses: int
+    puts: int
+
+    def __init__(
+        self,
+        max_entries: int = DEFAULT_TOOL_CACHE_MAX_ENTRIES,
+        max_age: timedelta | None = DEFAULT_TOOL_CACHE_MAX_AGE,
+    ) -> None:
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"<ToolCache(hits={self.hits}, misses={self.misses})>"
+
+    def get(self, key: str) -> str | None:
+        session = database.get_session()
+        cached = session.query(database.CachedToolResult).filter_by(key=key).first()
+
+        if (
+            cached is not None
+            and self.max_age is not None
+            and cached.created_at < datetime.utcnow() - self.max_age
+        ):
+            session.delete(cached)
+            session.commit()
+            cached = None
+
+        with self._lock:
+            if cached is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        cached.last_used_at = datetime.utcnow()
+        session.commit()
+        return cached.value
+
+    def put(self, key: str, tool: str, arguments: Mapping[str, Any], value: str) -> None:
+        session = database.get_session()
+        session.add(
+            database.CachedToolResult(
+                key=key,
+                tool=tool,
+                arguments=json.loads(json.dumps(arguments, default=str)),
+                value=value,
+            )
+        )
+        try:
+            session.commit()
+        except IntegrityError:
+            # the same call was made concurrently, and cached first
+            session.rollback()
+            return None
+
+        self.evict_if_due()
+        return None
+
+    def evict_if_due(self) -> None:
+        with self._lock:
+            self.puts += 1
+            due = self.puts % EVICT_EVERY == 0
+        if due:
+            self.evict()
+
+    def evict(self) -> int:
+        return evict(database.CachedToolResult, self.max_entries, self.max_age)
@@ -0,0 +1,106 @@
+"""Saving the result of each stage, and each batch of employees within a stage, to
+parquet as soon as it is generated, so a failed run can be carried on from where
+it stopped"""
+from __future__ import annotations
+import os
+import threading
+from pathlib import Path
+from typing import Any
+import polars as pl
+from loguru import logger
+
+from .scheduler import Stage
+
+PART_GLOB = "part-*.parquet"
+
+
+def write_parquet(df: pl.DataFrame, path: Path) -> None:
+    """Writes atomically, so a partly written file is never read back"""
+    partial_path = path.with_suffix(".parquet.partial")
+    df.write_parquet(partial_path)
+    os.replace(partial_path, path)
+
+
+def read_parquet(path: Path) -> pl.DataFrame:
+    return pl.read_parquet(path, memory_map=True)
+
+
+class Parts:
+    """Parts of a stage's result, e.g. the rows for each batch of employees"""
+
+    directory: Path
+
+    def __init__(self, directory: Path) -> None:
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"<Parts(directory={self.directory})>"
+
+    def load(self) -> pl.DataFrame | None:
+        paths = sorted(self.directory.glob(PART_GLOB))
+        if not paths:
+            return None
+        return pl.concat([read_parquet(path) for path in paths], how="vertical_relaxed")
+
+    def save(self, df: pl.DataFrame) -> Path:
+        with self._lock:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            number = len(list(self.directory.glob(PART_GLOB)))
+            path = self.directory / f"part-{number:05d}.parquet"
+            write_parquet(df, path)
+        return path
+
+
+class Checkpoints:
+    """A run directory holding a parquet file per finished stage, and a directory
+    of parts per stage that saves as it goes"""
+
+    directory: Path
+
+    def __init__(self, directory: Path, resume: bool = False) -> None:
+        self.directory = directory
+        if not resume and self.completed_stages():
+            raise FileExistsError(
+                f"{directory} already has checkpoints for {self.completed_stages()}, "
+                "resume from them or use another directory"
+            )
+
+    def __repr__(self) -> str:
+        return f"<Checkpoints(directory={self.directory})>"
+
+    def stage_path(self, name: str) -> Path:
+        return self.directory / f"{name}.parquet"
+
+    def completed_stages(self) -> list[str]:
+        return sorted(path.stem for path in self.directory.glob("*.parquet"))
+
+    def load(self, name: str) -> pl.DataFrame | None:
+        path = self.stage_path(name)
+        if not path.exists():
+            return None
+        return read_parquet(path)
+
+    def save(self, name: str, df: pl.DataFrame) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        write_parquet(df, self.stage_path(name))
+
+    def parts(self, name: str) -> Parts:
+        return Parts(self.directory / f"{name}.parts")
+
+
+def checkpoint_stage(stage: Stage, checkpoints: Checkpoints) -> Stage:
+    """The stage, but loading its result if it has already finished, and saving its
+    result when it does"""
+
+    def run(**inputs: Any) -> pl.DataFrame:
+        saved = checkpoints.load(stage.name)
+        if saved is not None:
+            logger.info(f"loaded stage {stage.name} from {checkpoints}")
+            return saved
+
+        result = stage.run(**inputs)
+        checkpoints.save(stage.name, result)
+        return result
+
+    return stage._replace(run=run)
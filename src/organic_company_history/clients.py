@@ -0,0 +1,280 @@
+"""Spreading requests over several ollama servers.
+
+Hosts are read from OLLAMA_HOSTS, a comma separated list of `host` or
+`host=max_concurrency`, falling back to OLLAMA_HOST (or ollama's default), or
+set with `configure`.
+"""
+from __future__ import annotations
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Iterator, Mapping, Sequence, TYPE_CHECKING
+from loguru import logger
+
+if TYPE_CHECKING:
+    import ollama
+
+DEFAULT_HOST_CONCURRENCY = 4
+"""Requests that can be in flight at once to a host without its own limit"""
+
+MIN_BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+"""Seconds a host is avoided after failing, doubling with each failure in a row"""
+
+
+def parse_host(host: str) -> tuple[str, int]:
+    """`host=max_concurrency`, or just `host`"""
+    host, _, max_concurrency = host.strip().partition("=")
+    return host, int(max_concurrency or DEFAULT_HOST_CONCURRENCY)
+
+
+def is_host_failure(error: Exception) -> bool:
+    """Whether an error was the host's fault, rather than the request's"""
+    import httpx
+    import ollama
+
+    if isinstance(error, ollama.ResponseError):
+        return error.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+class Endpoint:
+    """An ollama server, with a client that keeps its connections open"""
+
+    host: str
+    max_concurrency: int
+    outstanding: int
+    requests: int
+    failures: int
+    consecutive_failures: int
+    unhealthy_until: float
+
+    def __init__(self, host: str, max_concurrency: int = DEFAULT_HOST_CONCURRENCY):
+        self.host = host
+        self.max_concurrency = max_concurrency
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+        self._client: ollama.Client | None = None
+
+    def __repr__(self) -> str:
+        return (
+            f"<Endpoint(host={self.host}, outstanding={self.outstanding}, "
+            f"requests={self.requests}, failures={self.failures})>"
+        )
+
+    @property
+    def client(self) -> ollama.Client:
+        if self._client is None:
+            import httpx
+            import ollama
+
+            self._client = ollama.Client(
+                host=self.host or None,
+                limits=httpx.Limits(
+                    max_connections=self.max_concurrency,
+                    max_keepalive_connections=self.max_concurrency,
+                ),
+            )
+        return self._client
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.unhealthy_until
+
+    def succeeded(self) -> None:
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+
+    def failed(self, error: Exception) -> None:
+        self.failures += 1
+        self.consecutive_failures += 1
+        backoff = min(MIN_BACKOFF * 2 ** (self.consecutive_failures - 1), MAX_BACKOFF)
+        self.unhealthy_until = time.monotonic() + backoff
+        logger.warning(f"{self} failed, avoiding it for {backoff:.0f}s: {error}")
+
+
+class ClientPool:
+    """Sends each request to the healthy host with the fewest requests in flight
+    (relative to its limit), waiting while every host is at its limit. Requests that fail
+    because of the host are tried again on another host."""
+
+    _endpoints: list[Endpoint] | None
+
+    def __init__(self, hosts: Sequence[str] | None = None) -> None:
+        self._hosts = hosts
+        self._endpoints = None
+        self._condition = threading.Condition()
+
+    def __repr__(self) -> str:
+        return f"<ClientPool(endpoints={self._endpoints})>"
+
+    @property
+    def endpoints(self) -> list[Endpoint]:
+        with self._condition:
+            if self._endpoints is None:
+                hosts = self._hosts
+                if hosts is None:
+                    hosts = os.environ.get("OLLAMA_HOSTS", "").split(",")
+                hosts = [host for host in hosts if host.strip()] or [""]
+                self._endpoints = [Endpoint(*parse_host(host)) for host in hosts]
+            return self._endpoints
+
+    def choose(self, exclude: Sequence[Endpoint] = ()) -> Endpoint:
+        """Waits for an endpoint with spare capacity, preferring healthy ones. An
+        unhealthy endpoint is only used when every endpoint is unhealthy."""
+        candidates = [e for e in self.endpoints if e not in exclude] or self.endpoints
+        with self._condition:
+            while True:
+                available = [e for e in candidates if e.outstanding < e.max_concurrency]
+                healthy = [e for e in available if e.healthy]
+                if healthy or (available and not any(e.healthy for e in candidates)):
+                    endpoint = min(
+                        healthy or available,
+                        key=lambda e: (
+                            e.outstanding / e.max_concurrency,
+                            e.unhealthy_until,
+                        ),
+                    )
+                    endpoint.outstanding += 1
+                    endpoint.requests += 1
+                    return endpoint
+                self._condition.wait()
+
+    def release(self, endpoint: Endpoint) -> None:
+        with self._condition:
+            endpoint.outstanding -= 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def endpoint(self, exclude: Sequence[Endpoint] = ()) -> Iterator[Endpoint]:
+        endpoint = self.choose(exclude)
+        try:
+            yield endpoint
+        finally:
+            self.release(endpoint)
+
+    def chat(self, stream: bool = False, **kwargs: Any) -> Any:
+        """`ollama.chat` on the least busy host. Streams hold their host until they
+        are finished or closed."""
+        if stream:
+            return self._stream_chat(**kwargs)
+
+        tried: list[Endpoint] = []
+        while True:
+            with self.endpoint(exclude=tried) as endpoint:
+                try:
+                    response = endpoint.client.chat(**kwargs)
+                except Exception as e:
+                    if not is_host_failure(e):
+                        raise
+                    endpoint.failed(e)
+                    tried.append(endpoint)
+                    if len(tried) >= len(self.endpoints):
+                        raise
+                    continue
+
+                endpoint.succeeded()
+                return response
+
+    def _stream_chat(self, **kwargs: Any) -> Iterator[Mapping[str, Any]]:
+        tried: list[Endpoint] = []
+        while True:
+            with self.endpoint(exclude=tried) as endpoint:
+                chunks = endpoint.client.chat(stream=True, **kwargs)
+                try:
+                    first = next(chunks)
+                except StopIteration:
+                    return
+                except Exception as e:
+                    # nothing has been streamed yet, so another host can be tried
+                    if not is_host_failure(e):
+                        raise
+                    endpoint.failed(e)
+                    tried.append(endpoint)
+                    if len(tried) >= len(self.endpoints):
+                        raise
+                    continue
+
+                endpoint.succeeded()
+                try:
+                    yield first
+                    yield from chunks
+                finally:
+                    chunks.close()
+                return
+
+    def list(self) -> set[str]:
+        """Names of models that every reachable host has"""
+        models: set[str] | None = None
+        for endpoint in self.endpoints:
+            try:
+                listed = endpoint.client.list()["models"]
+            except Exception as e:
+                if not is_host_failure(e):
+                    raise
+                endpoint.failed(e)
+                continue
+
+            names = {model.get("name") or model.get("model") for model in listed}
+            models = names if models is None else models & names
+
+        if models is None:
+            raise Exception(f"Could not reach any of {self.endpoints}")
+        return models
+
+    def create(self, model: str, modelfile: str) -> None:
+        """Creates the model on every reachable host"""
+        created = False
+        for endpoint in self.endpoints:
+            try:
+                endpoint.client.create(model=model, modelfile=modelfile)
+            except Exception as e:
+                if not is_host_failure(e):
+                    raise
+                endpoint.failed(e)
+                continue
+            created = True
+
+        if not created:
+            raise Exception(f"Could not create {model} on any of {self.endpoints}")
+
+    def warm_up(
+        self, models: Sequence[str], keep_alive: float | str | None = None
+    ) -> None:
+        """Loads `models` on every reachable host, each host at the same time"""
+        from concurrent.futures import ThreadPoolExecutor
+
+        def load(endpoint: Endpoint) -> None:
+            for model in models:
+                try:
+                    # ollama loads a model when sent a chat without messages
+                    endpoint.client.chat(
+                        model=model, messages=[], keep_alive=keep_alive
+                    )
+                except Exception as e:
+                    if not is_host_failure(e):
+                        raise
+                    endpoint.failed(e)
+                    return
+            logger.info(f"loaded {len(models)} models on {endpoint}")
+
+        with ThreadPoolExecutor(max_workers=len(self.endpoints)) as pool:
+            list(pool.map(load, self.endpoints))
+
+    def configure(self, hosts: Sequence[str] | None) -> None:
+        """Sends requests to `hosts` instead, see `parse_host`. None reads them from
+        the environment again."""
+        with self._condition:
+            self._hosts = hosts
+            self._endpoints = None
+
+
+client_pool = ClientPool()
+
+
+def configure(hosts: Sequence[str] | None) -> None:
+    client_pool.configure(hosts)
@@ -1,6 +1,14 @@
 """Storing/loading LLM things in sqllite"""
+from __future__ import annotations
+from typing import Any, Mapping, Type, TYPE_CHECKING
 from sqlalchemy import (
+    bindparam,
     create_engine,
+    event,
+    func,
+    inspect,
+    select,
+    text,
     Boolean,
     Integer,
     String,
@@ -11,25 +19,80 @@ from sqlalchemy import (
     JSON,
 )
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.orm import relationship, scoped_session, sessionmaker
+from sqlalchemy.orm import Session as OrmSession
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.schema import Table
 from datetime import datetime
-import logging
+from loguru import logger
+from contextvars import ContextVar
+import atexit
+import queue
+import threading
+import time
+
+if TYPE_CHECKING:
+    import polars as pl
 
 DB_NAME = "organic-company-history.db"
-# logging.getLogger("sqlalchemy").setLevel(logging.WARNING)
+"""Default database - use `configure` to store things elsewhere (or not at all)"""
+
+SQLITE_PRAGMAS = (
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+    "temp_store=MEMORY",
+    "cache_size=-64000",
+    "busy_timeout=5000",
+)
+"""Favour write throughput - WAL lets readers and the background writer work at once"""
+
+FLUSH_INTERVAL = 1.0
+"""Max seconds a row waits in the write queue before being written"""
+
+FLUSH_SIZE = 500
+"""Number of queued rows that triggers a write"""
+
+ARROW_BATCH_ROWS = 2**24
+"""Rows the sqlite ADBC driver reads before settling on column types. Columns
+added by `add_missing_columns` are null in older rows, so as many rows as is
+reasonable are read in one batch, rather than taking a type from the first few"""
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(f"PRAGMA {pragma}")
+    cursor.close()
 
-engine = create_engine(f"sqlite:///{DB_NAME}", echo=False)
 
 Base = declarative_base()
 
 
+current_run_id: ContextVar[int | None] = ContextVar("current_run_id", default=None)
+"""The run that conversations started in this context belong to"""
+
+
+class Run(Base):
+    """One attempt at generating data, e.g. for an industry"""
+
+    __tablename__ = "runs"
+    id = Column(Integer, primary_key=True)
+    label = Column(String, nullable=True)
+    started_at = Column(DateTime, default=datetime.utcnow)
+
+    conversations = relationship("Conversation", back_populates="run")
+
+
 class Model(Base):
     __tablename__ = "models"
     id = Column(Integer, primary_key=True)
-    name = Column(String, nullable=False)
+    name = Column(String, nullable=False, index=True)
     base_model = Column(String, nullable=False)
     modelfile = Column(Text, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
+    output_format = Column(String, nullable=True)
+    """csv or json, see `polars_llm.OutputFormat`"""
 
     conversations = relationship("Conversation", back_populates="model")
     tools = relationship("Tool", back_populates="model")
@@ -38,17 +101,28 @@ class Model(Base):
 class Conversation(Base):
     __tablename__ = "conversations"
     id = Column(Integer, primary_key=True)
-    model_id = Column(Integer, ForeignKey("models.id"), nullable=False)
+    model_id = Column(Integer, ForeignKey("models.id"), nullable=False, index=True)
+    run_id = Column(Integer, ForeignKey("runs.id"), nullable=True)
+    stage = Column(String, nullable=True)
+    attempt = Column(Integer, nullable=True)
+    succeeded = Column(Boolean, nullable=True)
     started_at = Column(DateTime, default=datetime.utcnow)
+    candidate = Column(Integer, nullable=True)
+    """Index of the conversation in a race of speculative candidates"""
+    won = Column(Boolean, nullable=True)
+    """Whether the candidate's dataframe was the one used"""
 
     model = relationship("Model", back_populates="conversations")
+    run = relationship("Run", back_populates="conversations")
     messages = relationship("Message", back_populates="conversation")
 
 
 class Message(Base):
     __tablename__ = "messages"
     id = Column(Integer, primary_key=True)
-    conversation_id = Column(Integer, ForeignKey("conversations.id"), nullable=False)
+    conversation_id = Column(
+        Integer, ForeignKey("conversations.id"), nullable=False, index=True
+    )
     role = Column(String, nullable=False)
     content = Column(Text, nullable=False)
     timestamp = Column(DateTime, default=datetime.utcnow)
@@ -70,6 +144,7 @@ class Response(Base):
         Integer,
         ForeignKey("messages.id", ondelete="CASCADE"),
         nullable=False,
+        # unique, so sqlite already indexes it
         unique=True,
     )
     done_reason = Column(String, nullable=False)
@@ -79,6 +154,15 @@ class Response(Base):
     prompt_eval_count = Column(Integer, nullable=False)
     prompt_eval_duration = Column(Integer, nullable=False)
     total_duration = Column(Integer, nullable=False)
+    cached = Column(Boolean, nullable=True)
+    """Whether the response was served from the response cache"""
+    repairs = Column(String, nullable=True)
+    """Comma separated fixes made to the reply before parsing it, see `repair.Fix`"""
+    estimated_prompt_tokens = Column(Integer, nullable=True)
+    """Rough size of the whole prompt, more than prompt_eval_count when ollama
+    reused the evaluation of its start"""
+    outcome = Column(String, nullable=True)
+    """Whether the reply was a valid dataframe, or why not, see `policy.Failure`"""
 
     message = relationship(
         "Message",
@@ -106,8 +190,8 @@ class ToolCall(Base):
 
     __tablename__ = "tool_calls"
     id = Column(Integer, primary_key=True)
-    tool_id = Column(Integer, ForeignKey("tools.id"), nullable=False)
-    message_id = Column(Integer, ForeignKey("messages.id"), nullable=False)
+    tool_id = Column(Integer, ForeignKey("tools.id"), nullable=False, index=True)
+    message_id = Column(Integer, ForeignKey("messages.id"), nullable=False, index=True)
     arguments = Column(JSON, nullable=False)
 
     message = relationship("Message", back_populates="tool_calls", uselist=False)
@@ -123,13 +207,450 @@ class ToolResult(Base):
     call_id = Column(Integer, ForeignKey("tool_calls.id"), nullable=False)
     was_error = Column(Boolean, nullable=False)
     value_or_error = Column(Text, nullable=True)
+    was_cached = Column(Boolean, nullable=True)
 
     call = relationship("ToolCall", back_populates="result", uselist=False)
 
 
-# create tables
-Base.metadata.create_all(engine)
+class CachedResponse(Base):
+    """Responses from the LLM, keyed by a hash of everything that was sent to it"""
+
+    __tablename__ = "cached_responses"
+    id = Column(Integer, primary_key=True)
+    key = Column(String, nullable=False, unique=True, index=True)
+    response = Column(JSON, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.utcnow)
+
+
+class CachedToolResult(Base):
+    """Results of tool calls, keyed by a hash of the tool and its arguments"""
+
+    __tablename__ = "cached_tool_results"
+    id = Column(Integer, primary_key=True)
+    key = Column(String, nullable=False, unique=True, index=True)
+    tool = Column(String, nullable=False)
+    arguments = Column(JSON, nullable=False)
+    value = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.utcnow)
+
+
+class Archive(Base):
+    """Rows of a table that were moved to parquet files, see `maintenance.archive`"""
+
+    __tablename__ = "archives"
+    id = Column(Integer, primary_key=True)
+    table_name = Column(String, nullable=False, index=True)
+    directory = Column(String, nullable=False)
+    rows = Column(Integer, nullable=False)
+    max_id = Column(Integer, nullable=True)
+    """Largest id archived, so that ids aren't reused once the rows are gone"""
+    archived_before = Column(DateTime, nullable=False)
+    """Conversations started before this were archived"""
+    archived_at = Column(DateTime, default=datetime.utcnow)
+
+
+_path: str | None = DB_NAME
+_engine: Engine | None = None
+_engine_lock = threading.Lock()
+
+
+def configure(path: str | None = DB_NAME) -> None:
+    """Sets where LLM things are stored: a sqlite file, ':memory:', or None to
+    not keep conversation logs at all. Must be called before the database is used."""
+    global _path
+    if _engine is not None:
+        raise RuntimeError(
+            "The database is already in use, configure it before generating data"
+        )
+    _path = path
+
+
+def is_persistent() -> bool:
+    return _path is not None
+
+
+def make_engine(path: str | None) -> Engine:
+    if path is None or path == ":memory:":
+        # in memory databases are per connection, so every thread shares one
+        engine = create_engine(
+            "sqlite://",
+            poolclass=StaticPool,
+            connect_args={"check_same_thread": False},
+        )
+    else:
+        engine = create_engine(f"sqlite:///{path}", echo=False)
+
+    event.listen(engine, "connect", set_sqlite_pragmas)
+    return engine
+
+
+def get_engine() -> Engine:
+    """The engine for the configured database, creating it (and its tables) on first use"""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            engine = make_engine(_path)
+            Base.metadata.create_all(engine)
+            add_missing_columns(engine)
+            add_missing_indexes(engine)
+            Session.configure(bind=engine)
+            _engine = engine
+
+        return _engine
+
+
+def add_missing_columns(engine: Engine) -> None:
+    """Adds columns that are newer than the database's tables. sqlite can only add
+    columns without constraints, so new columns must be nullable."""
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+
+                column_type = column.type.compile(engine.dialect)
+                logger.info(f"adding column {table.name}.{column.name}")
+                connection.execute(
+                    text(
+                        f"ALTER TABLE {table.name} "
+                        f"ADD COLUMN {column.name} {column_type}"
+                    )
+                )
+
+
+def add_missing_indexes(engine: Engine) -> None:
+    """Adds indexes that are newer than the database's tables, as `create_all`
+    only creates the indexes of tables it creates"""
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing:
+                    continue
+
+                logger.info(f"adding index {index.name} to {table.name}")
+                index.create(connection)
+
+
+def get_session() -> OrmSession:
+    """The session for the current thread, for reading"""
+    get_engine()
+    return session()
+
+
+def polars_schema(*models: Type[Base]) -> dict[str, pl.DataType]:
+    """Polars types of the columns of `models`' tables, by column name. Columns of
+    later models take precedence where names are shared."""
+    import polars as pl
+
+    dtypes = {
+        Boolean: pl.Boolean(),
+        DateTime: pl.Datetime("us"),
+        Integer: pl.Int64(),
+    }
+    return {
+        column.name: next(
+            (dtype for kind, dtype in dtypes.items() if isinstance(column.type, kind)),
+            pl.String(),
+        )
+        for model in models
+        for column in model.__table__.columns
+    }
+
+
+def read_query(
+    query: str, schema: Mapping[str, pl.DataType] | None = None
+) -> pl.DataFrame:
+    """The result of a query as a dataframe, read in bulk rather than as ORM
+    objects - into arrow with the sqlite ADBC driver if it's installed. Result
+    columns named in `schema` are cast to its types, as sqlite has no types of its
+    own (dates are strings, booleans are integers, and columns that are entirely
+    null have no type at all)."""
+    import polars as pl
+
+    writer.flush()
+    frame = None
+    if _path is not None and _path != ":memory:":
+        try:
+            frame = read_query_arrow(query, _path)
+        except ImportError:
+            pass
+        except Exception as e:
+            # a column was null for a whole batch, then had values of another type
+            logger.warning(f"could not read query with ADBC, reading row by row: {e}")
+
+    if frame is None:
+        # in memory databases can only be read through the engine's connection,
+        # which gives rows as python objects
+        with get_engine().connect() as connection:
+            frame = pl.read_database(
+                text(query), connection=connection, infer_schema_length=None
+            )
+
+    return frame.with_columns(
+        pl.col(name).str.to_datetime(time_unit=dtype.time_unit)
+        if frame.schema[name] == pl.String and isinstance(dtype, pl.Datetime)
+        else pl.col(name).cast(dtype)
+        for name, dtype in (schema or {}).items()
+        if name in frame.columns
+    )
+
+
+def read_query_arrow(query: str, path: str) -> pl.DataFrame:
+    import adbc_driver_sqlite.dbapi
+    import polars as pl
+
+    with (
+        adbc_driver_sqlite.dbapi.connect(path) as connection,
+        connection.cursor() as cursor,
+    ):
+        cursor.adbc_statement.set_options(
+            **{"adbc.sqlite.query.batch_rows": str(ARROW_BATCH_ROWS)}
+        )
+        cursor.execute(query)
+        return pl.from_arrow(cursor.fetch_arrow_table())
+
+
+def read_table(model: Type[Base]) -> pl.DataFrame:
+    """Every row of `model`'s table, see `read_query`"""
+    return read_query(f"select * from {model.__tablename__}", polars_schema(model))
+
+
+class Writer:
+    """Writes rows to the database in batches from a background thread.
+
+    Ids are allocated as rows are queued, so rows can reference each other
+    before they have been written. They're allocated by this process alone, from
+    the largest id when the table is first written to, so only one process can
+    write to a database at a time - two processes writing to the same file would
+    hand out the same ids. Uses the configured database unless given an engine.
+
+    If a batch can't be written, its rows are written one at a time, so that one
+    bad row doesn't lose the rest. Rows that still can't be written are logged,
+    and counted in `rows_failed`.
+    """
+
+    engine: Engine | None
+    flush_interval: float
+    flush_size: int
+    rows_written: int
+    rows_failed: int
+    batches_written: int
+    write_seconds: float
+    """Time spent writing batches to the database"""
+
+    def __init__(
+        self,
+        engine: Engine | None = None,
+        flush_interval: float = FLUSH_INTERVAL,
+        flush_size: int = FLUSH_SIZE,
+    ) -> None:
+        self.engine = engine
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.rows_written = 0
+        self.rows_failed = 0
+        self.batches_written = 0
+        self.write_seconds = 0.0
+        self._queue: queue.Queue = queue.Queue()
+        self._ids: dict[str, int] = {}
+        self._unique_ids: dict[tuple, int] = {}
+        self._lock = threading.Lock()
+        self._unique_lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    def __repr__(self) -> str:
+        return (
+            f"<Writer(rows_written={self.rows_written}, "
+            f"rows_failed={self.rows_failed}, "
+            f"batches_written={self.batches_written})>"
+        )
+
+    def next_id(self, model: Type[Base]) -> int:
+        table = model.__table__
+        with self._lock:
+            if table.name not in self._ids:
+                with self.get_engine().connect() as connection:
+                    max_id = connection.execute(select(func.max(table.c.id))).scalar()
+                    archived_max_id = connection.execute(
+                        select(func.max(Archive.max_id)).where(
+                            Archive.table_name == table.name
+                        )
+                    ).scalar()
+                self._ids[table.name] = max(max_id or 0, archived_max_id or 0)
+
+            self._ids[table.name] += 1
+            return self._ids[table.name]
+
+    def get_engine(self) -> Engine:
+        return self.engine if self.engine is not None else get_engine()
+
+    @property
+    def discards_rows(self) -> bool:
+        return self.engine is None and not is_persistent()
+
+    def insert(self, model: Type[Base], **values: Any) -> int:
+        """Queues a row to be written, returning its id"""
+        table = model.__table__
+        if "id" not in values:
+            values["id"] = self.next_id(model)
+
+        if self.discards_rows:
+            return values["id"]
+
+        # evaluate defaults now, so timestamps are when the row was queued
+        for column in table.columns:
+            if column.name not in values and column.default is not None:
+                if column.default.is_callable:
+                    values[column.name] = column.default.arg(None)
+
+        self.start()
+        self._queue.put((table, values, False))
+        return values["id"]
+
+    def insert_unique(self, model: Type[Base], **values: Any) -> int:
+        """Like `insert`, but returns the id of a row with the same values if there
+        already is one, rather than queueing another"""
+        if self.discards_rows:
+            return self.insert(model, **values)
+
+        table = model.__table__
+        key = (table.name, tuple(sorted(values.items())))
+        with self._unique_lock:
+            if key not in self._unique_ids:
+                with self.get_engine().connect() as connection:
+                    same = (table.c[name] == value for name, value in values.items())
+                    existing_id = connection.execute(
+                        select(table.c.id).where(*same).order_by(table.c.id).limit(1)
+                    ).scalar()
+                self._unique_ids[key] = existing_id or self.insert(model, **values)
+
+            return self._unique_ids[key]
+
+    def update(self, model: Type[Base], id: int, **values: Any) -> None:
+        """Queues an update of the row with `id`, to be written after any queued inserts"""
+        if self.discards_rows:
+            return None
+
+        self.start()
+        self._queue.put((model.__table__, {"_id": id, **values}, True))
+        return None
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="database-writer", daemon=True
+                )
+                self._thread.start()
+
+    def flush(self) -> None:
+        """Blocks until every queued row has been written"""
+        if self._thread is None or not self._thread.is_alive():
+            return None
+
+        written = threading.Event()
+        self._queue.put(written)
+        written.wait()
+        return None
+
+    def close(self) -> None:
+        """Writes any queued rows and stops the background thread"""
+        if self._thread is None or not self._thread.is_alive():
+            return None
+
+        self._queue.put(None)
+        self._thread.join()
+        return None
+
+    def _run(self) -> None:
+        pending: list[tuple[Table, dict[str, Any], bool]] = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+
+            if isinstance(item, tuple):
+                pending.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+                if len(pending) < self.flush_size:
+                    continue
+
+            elif item is False and deadline is not None and time.monotonic() < deadline:
+                continue
+
+            self._write(pending)
+            pending = []
+            deadline = None
+
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is None:
+                return None
+
+    def _write(self, rows: list[tuple[Table, dict[str, Any], bool]]) -> None:
+        if not rows:
+            return None
+
+        started = time.perf_counter()
+
+        # insert into parent tables first, and update once everything is inserted
+        table_order = {table: i for i, table in enumerate(Base.metadata.sorted_tables)}
+        rows = sorted(rows, key=lambda row: (row[2], table_order[row[0]]))
+
+        # group rows that can be written together
+        groups: dict[tuple[bool, Table, tuple[str, ...]], list[dict[str, Any]]] = {}
+        for table, values, is_update in rows:
+            key = (is_update, table, tuple(sorted(values)))
+            groups.setdefault(key, []).append(values)
+
+        try:
+            with self.get_engine().begin() as connection:
+                for (is_update, table, _), values in groups.items():
+                    connection.execute(self.statement(table, is_update), values)
+        except Exception as e:
+            logger.warning(f"{self} could not write {len(rows)} rows at once: {e}")
+            self._write_each(rows)
+        else:
+            self.rows_written += len(rows)
+
+        self.batches_written += 1
+        self.write_seconds += time.perf_counter() - started
+        return None
+
+    def _write_each(self, rows: list[tuple[Table, dict[str, Any], bool]]) -> None:
+        for table, values, is_update in rows:
+            try:
+                with self.get_engine().begin() as connection:
+                    connection.execute(self.statement(table, is_update), values)
+            except Exception as e:
+                logger.error(f"{self} could not write {values} to {table.name}: {e}")
+                self.rows_failed += 1
+            else:
+                self.rows_written += 1
+
+    @staticmethod
+    def statement(table: Table, is_update: bool) -> Any:
+        if is_update:
+            # columns to set are taken from the keys of the values
+            return table.update().where(table.c.id == bindparam("_id"))
+        return table.insert()
+
+
+# session factory, for reading - objects are not expired on commit so that they
+# can be read without reloading, and each thread gets its own session. Bound to
+# an engine on first use by `get_engine`
+Session = sessionmaker(expire_on_commit=False)
+session = scoped_session(Session)
 
-# session factory
-Session = sessionmaker(bind=engine)
-session = Session()
+writer = Writer()
+atexit.register(writer.close)
@@ -0,0 +1,92 @@
+"""Message history for a conversation, and choosing which messages to send to the LLM"""
+from __future__ import annotations
+from typing import Literal, TYPE_CHECKING
+from loguru import logger
+
+if TYPE_CHECKING:
+    from ollama._types import Message
+
+DEFAULT_CONTEXT_SIZE = 2048
+"""Tokens in the model's context window, used unless `num_ctx` is set in the options"""
+
+REPLY_TOKEN_RESERVE = 512
+"""Tokens of the context window to leave free for the reply"""
+
+CHARS_PER_TOKEN = 4
+"""Rough number of characters per token, for estimating prompt size without a tokenizer"""
+
+PruningPolicy = Literal["keep_all", "keep_latest_retry"]
+"""keep_all - send every message. keep_latest_retry - send the original question,
+and only the latest failed reply and feedback"""
+
+
+def estimate_tokens(messages: list[Message]) -> int:
+    return sum(len(message["content"]) for message in messages) // CHARS_PER_TOKEN
+
+
+class History:
+    """Every message in a conversation, and the (possibly pruned) messages that are
+    sent to the LLM.
+
+    Messages are grouped into turns, each starting with a user message, so that a
+    reply and any tool calls it needed are kept or pruned together.
+    """
+
+    turns: list[list[Message]]
+    policy: PruningPolicy
+    token_budget: int
+    system_tokens: int
+    """Tokens used by a system message that isn't part of the history"""
+
+    def __init__(
+        self,
+        policy: PruningPolicy = "keep_all",
+        context_size: int = DEFAULT_CONTEXT_SIZE,
+        system_message: str = "",
+    ) -> None:
+        self.turns = []
+        self.policy = policy
+        self.token_budget = context_size - REPLY_TOKEN_RESERVE
+        self.system_tokens = len(system_message) // CHARS_PER_TOKEN
+
+    def __len__(self) -> int:
+        return sum(len(turn) for turn in self.turns)
+
+    def __repr__(self) -> str:
+        return f"<History(policy={self.policy}, messages={len(self)})>"
+
+    @property
+    def messages(self) -> list[Message]:
+        return [message for turn in self.turns for message in turn]
+
+    def append(self, message: Message) -> None:
+        if message["role"] == "user" or not self.turns:
+            self.turns.append([])
+        self.turns[-1].append(message)
+
+    def prune(self) -> list[list[Message]]:
+        """The turns to send, according to the pruning policy"""
+        if self.policy == "keep_all" or len(self.turns) <= 2:
+            return list(self.turns)
+
+        # original question, the latest failed reply, then the current turn
+        question, *_, latest, current = self.turns
+        return [question[:1], latest[-1:], current]
+
+    def prompt(self) -> list[Message]:
+        """The messages to send, dropping the oldest retries if they would not fit
+        in the context window"""
+        turns = self.prune()
+        tokens = self.system_tokens + estimate_tokens(
+            [message for turn in turns for message in turn]
+        )
+
+        while tokens > self.token_budget and len(turns) > 2:
+            tokens -= estimate_tokens(turns.pop(1))
+
+        if tokens > self.token_budget:
+            logger.warning(
+                f"{self} prompt is roughly {tokens} tokens, more than the budget of {self.token_budget}"
+            )
+
+        return [message for turn in turns for message in turn]
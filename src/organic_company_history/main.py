@@ -1,25 +1,395 @@
 """Generate and print data for a few silly industries"""
+from __future__ import annotations
 import argparse
-from os import get_terminal_size
-from .basis import make_data_for_industry, GeneratedData
+import sys
+from pathlib import Path
+from shutil import get_terminal_size
+from typing import Any, TYPE_CHECKING
 
-HLINE = "-" * get_terminal_size().columns
+# the rest of the package is slow to import, so is only imported once the
+# arguments have been parsed
+if TYPE_CHECKING:
+    import polars as pl
+    from .basis import GeneratedData
+    from .policy import AdaptiveRetryPolicy
 
 
-def demo(industry: str) -> GeneratedData:
-    print(f"\n{HLINE}\nGenerating data for {industry.title()}:\n")
-    return make_data_for_industry(industry)
+def adaptive_retry_policy() -> AdaptiveRetryPolicy:
+    """Learned from the runs in the configured database"""
+    from loguru import logger
+    from .policy import AdaptiveRetryPolicy
+
+    policy = AdaptiveRetryPolicy.from_database()
+    logger.info(
+        f"learned retry policy from {len(policy.fresh)} experts and "
+        f"{len(policy.after)} kinds of failure"
+    )
+    return policy
+
+
+def configure_logging(level: str = "INFO") -> None:
+    from loguru import logger
+
+    logger.remove()
+
+    # Add a new handler for INFO+ messages while keeping level-specific coloring
+    logger.add(
+        sys.stdout,
+        format="<green>{time:HH:mm:ss}</green> | <level>{level: <8}</level> | <cyan>{module}</cyan> - <level>{message}</level>",
+        level=level,
+        colorize=True,  # Keep level-specific coloring
+    )
+
+
+def parse_keep_alive(keep_alive: str) -> float | str:
+    """Seconds as a number, as ollama only reads durations with units as strings"""
+    try:
+        return float(keep_alive)
+    except ValueError:
+        return keep_alive
+
+
+def demo(
+    industry: str, cache: bool = False, cache_tools: bool = False, **options: Any
+) -> GeneratedData:
+    """Generates data for `industry`, `options` are passed to `make_data_for_industry`"""
+    from .basis import make_data_for_industry
+    from .cache import ResponseCache, ToolCache
+
+    response_cache = ResponseCache() if cache else None
+    tool_cache = ToolCache() if cache_tools else None
+
+    hline = "-" * get_terminal_size().columns
+    print(f"\n{hline}\nGenerating data for {industry.title()}:\n")
+    data = make_data_for_industry(
+        industry, cache=response_cache, tool_cache=tool_cache, **options
+    )
+    if response_cache is not None:
+        print(
+            f"\nresponse cache: {response_cache.hits} hits, {response_cache.misses} misses"
+        )
+    if tool_cache is not None:
+        print(f"tool cache: {tool_cache.hits} hits, {tool_cache.misses} misses")
+    return data
+
+
+def batch(
+    industries: list[str],
+    max_parallel: int = 1,
+    output_dir: Path | None = None,
+    table_dir: Path | None = None,
+    run_dir: Path | None = None,
+    cache: bool = False,
+    cache_tools: bool = False,
+    **options: Any,
+) -> pl.DataFrame:
+    """Generates data for each industry, running at most `max_parallel` industries
+    at once. Industries share the ollama hosts (and their concurrency limits),
+    database and response cache. Each industry's tables are saved to its own
+    directory in `output_dir`, and checkpointed to its own directory in
+    `run_dir`. Returns the time taken and rows generated for each industry, an
+    industry failing doesn't stop the others."""
+    from concurrent.futures import ThreadPoolExecutor
+    import time
+    import polars as pl
+    from loguru import logger
+    from .basis import industry_slug, make_data_for_industry, save_generated_data
+    from .cache import ResponseCache, ToolCache
+
+    response_cache = ResponseCache() if cache else None
+    tool_cache = ToolCache() if cache_tools else None
+
+    def run(industry: str) -> dict[str, Any]:
+        slug = industry_slug(industry)
+        started = time.perf_counter()
+        try:
+            data = make_data_for_industry(
+                industry,
+                cache=response_cache,
+                tool_cache=tool_cache,
+                table_dir=table_dir and table_dir / slug,
+                checkpoint_dir=run_dir and run_dir / slug,
+                **options,
+            )
+            if output_dir is not None:
+                save_generated_data(data, output_dir / slug)
+        except Exception as e:
+            logger.exception(f"could not generate data for {industry}")
+            return dict(
+                industry=industry,
+                succeeded=False,
+                seconds=time.perf_counter() - started,
+                rows=0,
+                error=str(e),
+            )
+
+        logger.info(f"generated data for {industry}")
+        return dict(
+            industry=industry,
+            succeeded=True,
+            seconds=time.perf_counter() - started,
+            rows=sum(df.height for df in data),
+            error=None,
+        )
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_parallel) as pool:
+        summary = pl.DataFrame(
+            list(pool.map(run, industries)),
+            schema={
+                "industry": pl.String,
+                "succeeded": pl.Boolean,
+                "seconds": pl.Float64,
+                "rows": pl.Int64,
+                "error": pl.String,
+            },
+        )
+
+    elapsed = time.perf_counter() - started
+    logger.info(
+        f"generated data for {summary['succeeded'].sum()} of {len(industries)} "
+        f"industries in {elapsed:.1f}s ({summary['seconds'].sum():.1f}s in total, "
+        f"{summary['rows'].sum() / elapsed:.1f} rows/s)"
+    )
+    if response_cache is not None:
+        logger.info(
+            f"response cache: {response_cache.hits} hits, {response_cache.misses} misses"
+        )
+    if tool_cache is not None:
+        logger.info(f"tool cache: {tool_cache.hits} hits, {tool_cache.misses} misses")
+    return summary
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
-        description="Generate and print data for a specified industry."
+        description="Generate and print data for the specified industries."
     )
     parser.add_argument(
         "industry",
         type=str,
-        help="The name of the industry for which to generate data.",
+        nargs="*",
+        help="The names of the industries for which to generate data.",
+    )
+    parser.add_argument(
+        "--industries-file",
+        type=str,
+        help="A file with more industries to generate data for, one per line.",
+    )
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=1,
+        help="The number of industries to generate data for at once.",
+    )
+    parser.add_argument(
+        "--output-dir",
+        type=str,
+        help="Save each industry's tables as parquet, in a directory per industry.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        help="The maximum number of LLM conversations to run at once.",
+    )
+    parser.add_argument(
+        "--employees-per-prompt",
+        type=int,
+        help="The number of employees to generate timesheets and payroll for in one prompt.",
+    )
+    parser.add_argument(
+        "--employees",
+        type=int,
+        help="The number of employees to generate, more than a page are generated a page at a time.",
+    )
+    parser.add_argument(
+        "--products",
+        type=int,
+        help="The minimum number of products to generate.",
+    )
+    parser.add_argument(
+        "--timesheets",
+        choices=["llm", "patterns"],
+        default="llm",
+        help="Have the LLM fill in every employee's timesheets, or a weekly pattern per job title that is expanded into timesheets.",
+    )
+    parser.add_argument(
+        "--timesheet-weeks",
+        type=int,
+        help="The number of weeks of timesheets to expand from the patterns.",
+    )
+    parser.add_argument(
+        "--table-dir",
+        type=str,
+        help="Save large tables here a page at a time, carrying on from any pages already saved.",
+    )
+    parser.add_argument(
+        "--run-dir",
+        type=str,
+        help="Save each stage, and each batch of employees, here as it finishes.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Carry on from the stages and batches already saved in --run-dir.",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Reuse responses from previous runs when the same messages are sent.",
+    )
+    parser.add_argument(
+        "--cache-tools",
+        action="store_true",
+        help="Reuse the results of tool calls from previous runs when a tool is called with the same arguments.",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream responses, stopping generation early if the csv header is wrong.",
+    )
+    parser.add_argument(
+        "--share-base-model",
+        action="store_true",
+        help="Run every expert on the base model, rather than creating a model per expert.",
+    )
+    parser.add_argument(
+        "--history-policy",
+        choices=["keep_all", "keep_latest_retry"],
+        default="keep_all",
+        help="Which messages of a conversation to send to the LLM when retrying.",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=["csv", "json"],
+        default="csv",
+        help="Whether experts reply with csvs, or json constrained to their schema.",
+    )
+    parser.add_argument(
+        "--json-experts",
+        nargs="+",
+        default=[],
+        help="Experts that reply with json, whatever the output format, e.g. hr payroll_data_entry.",
+    )
+    parser.add_argument(
+        "--candidates",
+        nargs="+",
+        default=[],
+        help="Race this many conversations for each question and use the first valid reply, for every expert (e.g. 3) or some (e.g. hr=3 payroll_data_entry=2).",
+    )
+    parser.add_argument(
+        "--adaptive-retries",
+        action="store_true",
+        help="Choose between retrying, restarting and giving up after a bad reply from how well each worked in earlier runs.",
+    )
+    parser.add_argument(
+        "--keep-alive",
+        type=str,
+        help="How long ollama keeps models loaded after a request, e.g. 30m, or seconds.",
+    )
+    parser.add_argument(
+        "--warm-up",
+        action="store_true",
+        help="Load each industry's models on every host before asking them anything.",
+    )
+    parser.add_argument(
+        "--hosts",
+        nargs="+",
+        help="Ollama hosts to spread requests over, as host or host=max_concurrency.",
+    )
+    parser.add_argument(
+        "--database",
+        type=str,
+        help="The sqlite file to store conversations in, or ':memory:'.",
+    )
+    parser.add_argument(
+        "--no-database",
+        action="store_true",
+        help="Don't store conversations at all.",
+    )
+    parser.add_argument(
+        "--log-level",
+        type=str,
+        default="INFO",
+        help="The minimum level of log messages to show.",
     )
     args = parser.parse_args()
 
-    demo(args.industry)
+    configure_logging(args.log_level)
+
+    if args.hosts:
+        from . import clients
+
+        clients.configure(args.hosts)
+
+    if args.database or args.no_database:
+        from . import database
+
+        database.configure(None if args.no_database else args.database)
+
+    industries = list(args.industry)
+    if args.industries_file:
+        lines = Path(args.industries_file).read_text().splitlines()
+        industries.extend(line.strip() for line in lines if line.strip())
+    if not industries:
+        parser.error("give at least one industry, or --industries-file")
+
+    # a number of candidates for every expert, or expert=number
+    candidates = {
+        expert: int(k)
+        for expert, _, k in (candidate.rpartition("=") for candidate in args.candidates)
+    }
+    optional = dict(
+        max_concurrency=args.concurrency,
+        employees_per_prompt=args.employees_per_prompt,
+        num_employees=args.employees,
+        num_products=args.products,
+        timesheet_weeks=args.timesheet_weeks,
+        candidates=candidates.get(""),
+        keep_alive=args.keep_alive and parse_keep_alive(args.keep_alive),
+        retry_policy=adaptive_retry_policy() if args.adaptive_retries else None,
+    )
+    options = dict(
+        stream=args.stream,
+        share_base_model=args.share_base_model,
+        history_policy=args.history_policy,
+        output_format=args.output_format,
+        output_formats={expert: "json" for expert in args.json_experts},
+        expert_candidates={
+            expert: k for expert, k in candidates.items() if expert
+        },
+        resume=args.resume,
+        timesheet_mode=args.timesheets,
+        warm_up=args.warm_up,
+        **{name: value for name, value in optional.items() if value is not None},
+    )
+    table_dir = Path(args.table_dir) if args.table_dir else None
+    run_dir = Path(args.run_dir) if args.run_dir else None
+    if args.resume and run_dir is None:
+        parser.error("--resume needs a --run-dir to resume from")
+
+    if len(industries) == 1 and args.output_dir is None:
+        from .basis import industry_slug
+
+        slug = industry_slug(industries[0])
+        demo(
+            industries[0],
+            cache=args.cache,
+            cache_tools=args.cache_tools,
+            table_dir=table_dir and table_dir / slug,
+            checkpoint_dir=run_dir and run_dir / slug,
+            **options,
+        )
+    else:
+        summary = batch(
+            industries,
+            max_parallel=args.parallel,
+            output_dir=Path(args.output_dir) if args.output_dir else None,
+            table_dir=table_dir,
+            run_dir=run_dir,
+            cache=args.cache,
+            cache_tools=args.cache_tools,
+            **options,
+        )
+        print(summary)
+        if not summary["succeeded"].all():
+            sys.exit(1)
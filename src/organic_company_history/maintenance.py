@@ -0,0 +1,341 @@
+"""python -m organic_company_history.maintenance
+
+Archiving old conversations to parquet, pruning failed ones, and compacting the database.
+"""
+from __future__ import annotations
+import argparse
+import os
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Literal, Type
+import polars as pl
+from loguru import logger
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from . import database
+from .checkpoints import write_parquet
+
+ARCHIVE_DIR = "organic-company-history-archive"
+
+ARCHIVE_AFTER = timedelta(days=30)
+"""Conversations older than this are moved to the archive, by default"""
+
+PRUNE_AFTER = timedelta(days=7)
+"""Failed conversations older than this are pruned, by default"""
+
+PrunePolicy = Literal["keep", "content", "delete"]
+"""keep - leave failed conversations alone. content - empty their messages, but
+keep the metrics that `report` and `policy.AdaptiveRetryPolicy` use. delete - remove
+them entirely, so the retry policy only learns from conversations that worked"""
+
+ARCHIVED: dict[Type[database.Base], str] = {
+    database.Conversation: "conversations",
+    database.Message: """messages
+        join conversations on conversations.id = messages.conversation_id""",
+    database.Response: """responses
+        join messages on messages.id = responses.message_id
+        join conversations on conversations.id = messages.conversation_id""",
+    database.ToolCall: """tool_calls
+        join messages on messages.id = tool_calls.message_id
+        join conversations on conversations.id = messages.conversation_id""",
+    database.ToolResult: """tool_results
+        join tool_calls on tool_calls.id = tool_results.call_id
+        join messages on messages.id = tool_calls.message_id
+        join conversations on conversations.id = messages.conversation_id""",
+}
+"""Tables archived with the conversations they're part of, parents first, and how
+their rows are joined to their conversation"""
+
+SNAPSHOTTED: tuple[Type[database.Base], ...] = (
+    database.Run,
+    database.Model,
+    database.Tool,
+)
+"""Tables that stay in the database, and are copied whole into the archive so that
+it can be queried on its own"""
+
+PARTITIONS = ["date", "expert"]
+
+
+def timestamp(moment: datetime) -> str:
+    """As sqlalchemy stores datetimes in sqlite, so they can be compared as strings"""
+    return moment.strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+def dedupe(
+    connection: Connection,
+    table: str,
+    columns: list[str],
+    references: list[tuple[str, str]],
+) -> int:
+    """Deletes rows of `table` that have the same `columns` as an earlier row,
+    pointing the `references` (table, column) to them at the earlier row instead.
+    Returns the number of rows deleted."""
+    same = ", ".join(f"coalesce({column}, '')" for column in columns)
+    connection.execute(text("drop table if exists temp.kept_ids"))
+    connection.execute(
+        text(
+            f"""create temp table kept_ids as
+            select * from (
+                select id, min(id) over (partition by {same}) as kept_id from {table}
+            ) where id != kept_id"""
+        )
+    )
+    for referencing_table, column in references:
+        connection.execute(
+            text(
+                f"""update {referencing_table}
+                set {column} = (select kept_id from kept_ids where id = {column})
+                where {column} in (select id from kept_ids)"""
+            )
+        )
+    deleted = connection.execute(
+        text(f"delete from {table} where id in (select id from kept_ids)")
+    ).rowcount
+    connection.execute(text("drop table temp.kept_ids"))
+    return deleted
+
+
+def dedupe_models() -> tuple[int, int]:
+    """Merges identical models, then identical tools of each model, as every
+    expert used to get a new model row each run. Returns the number of models and
+    tools removed."""
+    with database.get_engine().begin() as connection:
+        models = dedupe(
+            connection,
+            "models",
+            ["name", "base_model", "modelfile", "output_format"],
+            [("conversations", "model_id"), ("tools", "model_id")],
+        )
+        tools = dedupe(
+            connection,
+            "tools",
+            ["model_id", "name", "docstring", "annotations", "is_hallucination"],
+            [("tool_calls", "tool_id")],
+        )
+
+    logger.info(f"removed {models} duplicate models and {tools} duplicate tools")
+    return models, tools
+
+
+def archive(directory: Path, before: datetime) -> int:
+    """Moves conversations started `before` (and their messages, responses and tool
+    calls) out of the database, into zstd compressed parquet files partitioned by
+    the date the conversation started and its expert, e.g.
+    `messages/date=2024-10-01/expert=hr/20241101T020000.parquet`.
+
+    The runs, models and tools tables are copied whole, for joining to. Returns
+    the number of conversations archived."""
+    archived_at = datetime.utcnow()
+    cutoff = timestamp(before)
+    name = f"{archived_at:%Y%m%dT%H%M%S}.parquet"
+
+    frames = {
+        model: database.read_query(
+            f"""select {model.__tablename__}.*,
+                date(conversations.started_at) as date,
+                models.name as model_name
+            from {joins}
+            join models on models.id = conversations.model_id
+            where conversations.started_at < '{cutoff}'""",
+            {
+                **database.polars_schema(model),
+                "date": pl.String(),
+                "model_name": pl.String(),
+            },
+        )
+        .with_columns(expert=pl.col("model_name").str.split("/").list.last())
+        .drop("model_name")
+        for model, joins in ARCHIVED.items()
+    }
+    conversations = frames[database.Conversation].height
+    if conversations == 0:
+        logger.info(f"no conversations started before {cutoff} to archive")
+        return 0
+
+    written = []
+    try:
+        for model, frame in frames.items():
+            for (date, expert), partition in frame.group_by(PARTITIONS):
+                path = (
+                    directory
+                    / model.__tablename__
+                    / f"date={date}"
+                    / f"expert={expert}"
+                    / name
+                )
+                path.parent.mkdir(parents=True, exist_ok=True)
+                write_parquet(partition.drop(PARTITIONS), path)
+                written.append(path)
+
+        for model in SNAPSHOTTED:
+            path = directory / f"{model.__tablename__}.parquet"
+            write_parquet(database.read_table(model), path)
+
+        with database.get_engine().begin() as connection:
+            for model, frame in frames.items():
+                connection.execute(
+                    database.Archive.__table__.insert(),
+                    {
+                        "table_name": model.__tablename__,
+                        "directory": str(directory),
+                        "rows": frame.height,
+                        "max_id": frame["id"].max(),
+                        "archived_before": before,
+                        "archived_at": archived_at,
+                    },
+                )
+
+            # children first, while their rows can still be joined to conversations
+            for model, joins in reversed(ARCHIVED.items()):
+                table = model.__tablename__
+                connection.execute(
+                    text(
+                        f"""delete from {table} where id in (
+                            select {table}.id from {joins}
+                            where conversations.started_at < '{cutoff}'
+                        )"""
+                    )
+                )
+
+    except Exception:
+        # the rows are still in the database, don't archive them twice
+        for path in written:
+            path.unlink(missing_ok=True)
+        raise
+
+    logger.info(
+        f"archived {conversations} conversations started before {cutoff} to {directory}"
+    )
+    return conversations
+
+
+def scan_archive(directory: Path, table: str) -> pl.LazyFrame:
+    """An archived table, e.g. messages, with the date and expert columns its files
+    are partitioned by. Tables that aren't partitioned (runs, models and tools) are
+    read from their copy."""
+    copy = directory / f"{table}.parquet"
+    if copy.exists():
+        return pl.scan_parquet(copy)
+    return pl.scan_parquet(directory / table / "**/*.parquet", hive_partitioning=True)
+
+
+def prune(policy: PrunePolicy, before: datetime) -> int:
+    """Prunes conversations started `before` that are known not to have ended with
+    a valid dataframe, e.g. attempts that were restarted, or candidates that lost
+    a race. Returns the number of conversations pruned."""
+    if policy == "keep":
+        return 0
+
+    # conversations recorded before their outcome was have a null succeeded, so
+    # aren't known to have failed
+    failed = f"""select id from conversations
+        where coalesce(succeeded, 1) = 0
+        and started_at < '{timestamp(before)}'"""
+    with database.get_engine().begin() as connection:
+        if policy == "content":
+            pruned = connection.execute(
+                text(
+                    f"""select count(distinct conversation_id) from messages
+                    where conversation_id in ({failed}) and content != ''"""
+                )
+            ).scalar()
+            connection.execute(
+                text(
+                    f"""update messages set content = ''
+                    where conversation_id in ({failed}) and content != ''"""
+                )
+            )
+        else:
+            pruned = connection.execute(text(f"select count(*) from ({failed})")).scalar()
+            for model, joins in reversed(ARCHIVED.items()):
+                table = model.__tablename__
+                connection.execute(
+                    text(
+                        f"""delete from {table} where id in (
+                            select {table}.id from {joins}
+                            where conversations.id in ({failed})
+                        )"""
+                    )
+                )
+
+    logger.info(f"pruned ({policy}) {pruned} failed conversations")
+    return pruned or 0
+
+
+def database_bytes(path: str) -> int:
+    return sum(
+        os.path.getsize(file)
+        for file in (path, f"{path}-wal")
+        if os.path.exists(file)
+    )
+
+
+def vacuum() -> None:
+    """Rebuilds the database file without the space left by deleted rows"""
+    engine = database.get_engine()
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text("VACUUM"))
+        connection.execute(text("PRAGMA wal_checkpoint(TRUNCATE)"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[-1])
+    parser.add_argument(
+        "--database",
+        type=str,
+        default=database.DB_NAME,
+        help="The sqlite file conversations are stored in.",
+    )
+    parser.add_argument(
+        "--archive-dir",
+        type=str,
+        default=ARCHIVE_DIR,
+        help="Where to write archived conversations.",
+    )
+    parser.add_argument(
+        "--archive-after",
+        type=float,
+        default=ARCHIVE_AFTER.days,
+        help="Archive conversations started more than this many days ago.",
+    )
+    parser.add_argument(
+        "--no-archive",
+        action="store_true",
+        help="Keep every conversation in the database.",
+    )
+    parser.add_argument(
+        "--prune",
+        choices=["keep", "content", "delete"],
+        default="content",
+        help="What to do with failed conversations that aren't archived.",
+    )
+    parser.add_argument(
+        "--prune-after",
+        type=float,
+        default=PRUNE_AFTER.days,
+        help="Prune failed conversations started more than this many days ago.",
+    )
+    parser.add_argument(
+        "--no-vacuum",
+        action="store_true",
+        help="Don't compact the database file afterwards.",
+    )
+    args = parser.parse_args()
+
+    database.configure(args.database)
+    size = database_bytes(args.database)
+    now = datetime.utcnow()
+
+    dedupe_models()
+    if not args.no_archive:
+        archive(Path(args.archive_dir), now - timedelta(days=args.archive_after))
+    prune(args.prune, now - timedelta(days=args.prune_after))
+    if not args.no_vacuum:
+        vacuum()
+
+    logger.info(
+        f"{args.database} went from {size / 1e6:.1f}MB "
+        f"to {database_bytes(args.database) / 1e6:.1f}MB"
+    )
@@ -1,36 +1,59 @@
-from typing import Type, Callable, Any, Sequence, Literal
-import ollama
-from ollama._types import Message, Tool, BaseGenerateResponse
+from __future__ import annotations
+from typing import Type, Callable, Any, Iterator, Sequence, Literal, TYPE_CHECKING
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextvars import copy_context
+import copy
+import json
+import threading
+import time
 from collections.abc import Mapping
-import string
 import polars as pl
 from typing import NamedTuple
 from io import BytesIO
-from pandera.polars import DataFrameModel
-from pandera.errors import SchemaErrors, SchemaError
 import polars.selectors as cs
 from . import database
+from .cache import ResponseCache, ToolCache, make_cache_key
+from .tools import ToolExecutor
+from .registry import model_registry
+from .clients import client_pool
+from .history import History, PruningPolicy, DEFAULT_CONTEXT_SIZE, estimate_tokens
+from .scheduler import current_stage
+from .repair import repair_csv
+from .policy import VALID, Failure, RetryPolicy, expert_of
+from .validation import (
+    CompiledSchema,
+    compile_schema,
+    validate,
+)
 from loguru import logger
 
-import sys
+# ollama and pandera are slow to import, so are imported when first needed
+if TYPE_CHECKING:
+    from ollama._types import Message, Tool
+    from pandera.polars import DataFrameModel
 
-logger.remove()
+DEFAULT_BASE_MODEL = "llama3.1"
 
-# Add a new handler for INFO+ messages while keeping level-specific coloring
-logger.add(
-    sys.stdout,
-    format="<green>{time:HH:mm:ss}</green> | <level>{level: <8}</level> | <cyan>{module}</cyan> - <level>{message}</level>",
-    level="INFO",  # Only log INFO and above
-    colorize=True,  # Keep level-specific coloring
-)
+STREAM_ABORTED_DONE_REASON = "bad_header"
+"""done_reason recorded for streamed responses that were stopped early"""
 
-DEFAULT_BASE_MODEL = "llama3.1"
+HEADER_SEARCH_LINES = 5
+"""Lines of a streamed reply searched for its csv header, after which the header
+is only checked once the reply is finished"""
+
+DEFAULT_CONCURRENCY = 4
+"""Number of conversations that can be in flight at once when generating many dataframes"""
 
-DEFAULT_ATTEMPTS = 2
-"""Number of times to completely do over regeneration (if retries dont work)"""
+MAX_KEYS_IN_CONTINUATION = 30
+"""Number of the latest keys listed when asking for the next page of a table"""
 
-DEFAULT_RETRIES = 3
-"""Number of retries to regenerate a valid dataframe (using feedback)"""
+MAX_STALLED_PAGES = 3
+"""Pages in a row without any new rows before giving up on a table"""
+
+PAGE_CONTINUATION = (
+    "{rows_done} rows have already been generated, ending with these {key_names}: "
+    "{recent_keys}. Carry on from there, without repeating any of them."
+)
 
 
 SYSTEM_MESSAGE_CSV_REQS = (
@@ -41,6 +64,27 @@ SYSTEM_MESSAGE_CSV_REQS = (
     "Boolean fields should use the values true and false. "
 )
 
+SYSTEM_MESSAGE_JSON_REQS = (
+    "Provide responses as a JSON object with a 'rows' array, holding an object "
+    "for each row. "
+    "All dates should be in YYYY-MM-DD format. "
+    "Ensure all values are able to be coerced into that field's data type. "
+)
+
+DEFAULT_TEMPERATURE = 0.8
+"""ollama's temperature, unless it is set in the options"""
+
+CANDIDATE_TEMPERATURE_STEP = 0.1
+"""How much hotter each speculative candidate is than the one before it"""
+
+ATTEMPT_SEED_STEP = 1_000
+"""How far apart the seeds of each attempt are, when a seed is set, so a restarted
+conversation doesn't sample the same reply again. A candidate's seed is offset by
+its index within the step"""
+
+OutputFormat = Literal["csv", "json"]
+"""csv - replies are csvs, repaired and checked before parsing. json - replies are
+constrained by ollama to a json schema derived from the pandera model"""
 
 Role = Literal["user", "assistant", "system", "tool"]
 
@@ -51,6 +95,17 @@ class ColumnCheck(NamedTuple):
     extra: set[str]
 
 
+class Cancelled(Exception):
+    """Raised in a speculative candidate once another candidate has won"""
+
+
+class Feedback(NamedTuple):
+    failure: Failure
+    question: str
+    """What to ask the LLM to fix"""
+    reply: str
+
+
 class CSVFormatError(Exception):
     """Raised when the LLM has generated an invalid CSV"""
 
@@ -67,15 +122,52 @@ class PolarsLLM:
     name: str
     expertise: str
     schema: Type[DataFrameModel]
+    compiled_schema: CompiledSchema
     reply_parser: Callable[[pl.DataFrame], pl.DataFrame]
+    filled: Mapping[str, Any]
+    """Columns whose values are already known, filled in rather than asked for"""
     questioner: Callable[..., str]
+    context_maker: Callable[..., str] | None
+    context: str | None
+    """Shared by every question in a stage, sent in the system message so that the
+    start of each prompt is the same, and ollama can reuse its evaluation"""
+    keep_alive: float | str | None
+    retry_policy: RetryPolicy
+    candidates: int
+    """Conversations raced for each question, the first valid dataframe wins"""
+    candidate: int | None
+    """Index of this expert in a race, None if it isn't a speculative candidate"""
+    cancelled: threading.Event | None
+    seed: int | None
+    """Seed the seed of each attempt is derived from, None to let ollama choose"""
     formatted_tools: Sequence[Tool]
+    options: Mapping[str, Any] | None
+    cache: ResponseCache | None
+    reply_cache_key: str | None
+    """Cache key of the latest reply, if it was, or could be, cached"""
+    uncached_reply: Mapping[str, Any] | None
+    """The latest reply, cached once it's known to be valid"""
+    stream: bool
 
-    modelfile: str
+    share_base_model: bool
 
-    model: database.Model
-    current_conversation: database.Conversation
-    callable_tools: dict[str, Callable]
+    base_model: str
+    modelfile: str
+    system_message: str
+    ollama_model: str
+    """Name of the ollama model that is sent messages"""
+
+    model_id: int
+    conversation_id: int | None
+    """None until the first message is sent, so forks that are never asked
+    anything aren't recorded"""
+    attempt: int
+    history: History
+    history_policy: PruningPolicy
+    context_size: int
+    latest_message_id: int | None
+    latest_response_id: int | None
+    tool_executor: ToolExecutor
 
     def __init__(
         self,
@@ -84,12 +176,40 @@ class PolarsLLM:
         schema: Type[DataFrameModel],
         questioner: str | Callable[..., str],
         reply_parser: Callable[[pl.DataFrame], pl.DataFrame] | None = None,
+        context: str | Callable[..., str] | None = None,
         base_model: str = DEFAULT_BASE_MODEL,
         tools: list[Callable] = list(),
+        options: Mapping[str, Any] | None = None,
+        cache: ResponseCache | None = None,
+        tool_cache: ToolCache | None = None,
+        stream: bool = False,
+        share_base_model: bool = False,
+        history_policy: PruningPolicy = "keep_all",
+        output_format: OutputFormat = "csv",
+        keep_alive: float | str | None = None,
+        candidates: int = 1,
+        retry_policy: RetryPolicy | None = None,
     ) -> None:
         self.name = name
         self.schema = schema
+        self.compiled_schema = compile_schema(schema)
+        self.filled = {}
         self.expertise = expertise
+        self.options = options
+        self.seed = (options or {}).get("seed")
+        self.cache = cache
+        self.reply_cache_key = None
+        self.uncached_reply = None
+        self.stream = stream
+        self.share_base_model = share_base_model
+        self.history_policy = history_policy
+        self.output_format = output_format
+        self.keep_alive = keep_alive
+        self.candidates = candidates
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.candidate = None
+        self.cancelled = None
+        self.context_size = (options or {}).get("num_ctx", DEFAULT_CONTEXT_SIZE)
 
         if reply_parser is None:
             self.reply_parser = lambda df: df
@@ -101,332 +221,671 @@ class PolarsLLM:
         else:
             self.questioner = questioner
 
-        modelfile = self.make_modelfile(base_model=base_model)
+        if isinstance(context, str):
+            self.context_maker = None
+            self.context = context
+        else:
+            self.context_maker = context
+            self.context = None
 
-        try:
-            ollama.create(model=name, modelfile=modelfile)
-            logger.info(f"created model={name} with {modelfile=}")
-        except ollama.ResponseError as e:
-            # sometimes have gotten error due to model already existing - but
-            # have not been able to reproduce - might have to handle deleting
-            # existing model at some point?
-            breakpoint()
-
-        logger.info(f"created model {name} using {base_model}")  # TODO: convert to logs
-        logger.debug(f"{name}.Modelfile\n{modelfile}")
+        self.system_message = self.make_system_message()
+        modelfile = format_modelfile(
+            base_model=base_model, system_msg=self.system_message
+        )
+        self.base_model = base_model
+        self.modelfile = modelfile
+
+        if share_base_model:
+            # system message is sent with every conversation instead
+            self.ollama_model = base_model
+        else:
+            self.ollama_model = model_registry.get_or_create(name, modelfile)
 
-        # janky orm things
-        model = database.Model(name=name, base_model=base_model, modelfile=modelfile)
+        logger.info(f"{self} using model {self.ollama_model}")
+        logger.debug(f"{name}.Modelfile\n{modelfile}")
 
-        database.session.add(model)
-        database.session.commit()
-        self.model = model
+        # identical models (e.g. the same expert in every run) share a row
+        self.model_id = database.writer.insert_unique(
+            database.Model,
+            name=name,
+            base_model=base_model,
+            modelfile=modelfile,
+            output_format=output_format,
+        )
 
-        self.init_tools(tools)
+        self.tool_executor = ToolExecutor(self.model_id, tools, cache=tool_cache)
         self.formatted_tools = self.format_tools()
         self.start_conversation()
 
     @property
-    def latest_message(self) -> database.Message:
-        return self.current_conversation.messages[-1]
+    def system_prompt(self) -> str:
+        """The system message, followed by the shared context if there is one"""
+        if self.context is None:
+            return self.system_message
+        return f"{self.system_message}\n\n{self.context}"
+
+    @property
+    def sends_system_message(self) -> bool:
+        """Whether the system prompt is sent with each conversation, rather than
+        being the model's own"""
+        return self.share_base_model or self.context is not None
 
     @property
     def message_history(self) -> list[Message]:
-        return [
-            {"role": message.role, "content": message.content}
-            for message in self.current_conversation.messages
-        ]
-
-    def init_tools(self, tools: list[Callable]) -> None:
-        self.callable_tools = {tool.__name__: tool for tool in tools}
-        for tool in tools:
-            orm_tool = database.Tool(
-                model_id=self.model.id,
-                name=tool.__name__,
-                docstring=tool.__doc__,
-                annotations=str(tool.__annotations__),
-                is_hallucination=False,
-            )
-            database.session.add(orm_tool)
-        database.session.commit()
+        if self.sends_system_message:
+            # a system message replaces the model's, so has to include it
+            system: Message = {"role": "system", "content": self.system_prompt}
+            return [system, *self.history.prompt()]
+
+        return self.history.prompt()
 
-    def start_conversation(self) -> None:
-        """Start a new conversation with message history"""
+    def start_conversation(self, attempt: int = 0) -> None:
+        """Start a new conversation with message history, it's recorded when the
+        first message is sent"""
         logger.debug(f"{self} Starting new conversation")
-        conversation = database.Conversation(model_id=self.model.id)
-        database.session.add(conversation)
-        database.session.commit()
-        self.current_conversation = conversation
+        if self.seed is not None:
+            self.options = {
+                **(self.options or {}),
+                "seed": self.seed + ATTEMPT_SEED_STEP * attempt,
+            }
+        self.attempt = attempt
+        self.conversation_id = None
+        self.history = History(
+            policy=self.history_policy,
+            context_size=self.context_size,
+            system_message=self.system_prompt,
+        )
+        self.latest_message_id = None
+        self.latest_response_id = None
+
+    def fork(self) -> PolarsLLM:
+        """Copy of this expert that shares the model, but has its own conversation"""
+        forked = copy.copy(self)
+        forked.start_conversation()
+        return forked
+
+    def with_context(self, **kwargs: Any) -> PolarsLLM:
+        """Fork of this expert with its shared context filled in with `kwargs`.
+        Questions asked by the fork (and its forks) only need the parts that
+        differ between questions."""
+        if self.context_maker is None:
+            raise ValueError(f"{self} has no context to fill in")
+
+        forked = copy.copy(self)
+        forked.context = self.context_maker(**kwargs)
+        forked.start_conversation()
+        return forked
+
+    def filling(self, **columns: Any) -> PolarsLLM:
+        """Fork of this expert that fills in `columns` with the given values,
+        whether or not replies include them"""
+        forked = self.fork()
+        forked.filled = {**self.filled, **columns}
+        return forked
+
+    def make_candidate(self, index: int, cancelled: threading.Event) -> PolarsLLM:
+        """Fork of this expert for a race, sampling with its own seed (if one is
+        set) and a hotter temperature the later it is, that stops when `cancelled`
+        is set. Candidates are streamed, so they can be stopped part way through a
+        reply."""
+        candidate = copy.copy(self)
+        options = dict(self.options or {})
+        temperature = options.get("temperature", DEFAULT_TEMPERATURE)
+        candidate.options = {
+            **options,
+            "temperature": temperature + CANDIDATE_TEMPERATURE_STEP * index,
+        }
+        candidate.seed = None if self.seed is None else self.seed + index
+        candidate.stream = True
+        candidate.candidates = 1
+        candidate.candidate = index
+        candidate.cancelled = cancelled
+        candidate.start_conversation()
+        return candidate
+
+    def race(self, **kwargs: Any) -> pl.DataFrame:
+        """Asks `candidates` forks the same question at once, returning the first
+        valid dataframe. The others are cancelled, closing their streams, which
+        stops generation on the server."""
+        cancelled = threading.Event()
+        candidates = [self.make_candidate(i, cancelled) for i in range(self.candidates)]
+        # candidates are recorded against the same run and stage
+        contexts = [copy_context() for _ in candidates]
+        pool = ThreadPoolExecutor(max_workers=len(candidates))
+        futures = {
+            pool.submit(context.run, candidate.generate_data, **kwargs): candidate
+            for context, candidate in zip(contexts, candidates)
+        }
+        errors: list[Exception] = []
+        try:
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    errors.append(e)
+                    continue
+
+                cancelled.set()
+                winner = futures[future]
+                database.writer.update(
+                    database.Conversation, winner.conversation_id, won=True
+                )
+                logger.info(
+                    f"{self} candidate {winner.candidate} won a race of {len(candidates)}"
+                )
+                return result
+        finally:
+            cancelled.set()
+            # losers finish in the background, without being waited for
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        raise Exception(
+            f"Could not generate data for {self.name} with {len(candidates)} candidates"
+        ) from errors[-1]
+
+    def check_cancelled(self) -> None:
+        if self.cancelled is not None and self.cancelled.is_set():
+            raise Cancelled(f"{self} candidate {self.candidate} was cancelled")
+
+    def warm_up(self) -> None:
+        """Loads the model on every host, so the first question doesn't wait for it"""
+        client_pool.warm_up([self.ollama_model], keep_alive=self.keep_alive)
 
     def record_message(self, msg: Message) -> None:
-        if "content" in msg:
-            message = database.Message(
-                conversation_id=self.current_conversation.id,
-                role=msg["role"],
-                content=msg["content"] or "",
-            )
-        else:
-            breakpoint()
+        if "content" not in msg:
+            logger.error(f"{self} message has no content, so isn't recorded: {msg}")
             return None
 
-        database.session.add(message)
-        database.session.commit()
+        if self.conversation_id is None:
+            self.conversation_id = database.writer.insert(
+                database.Conversation,
+                model_id=self.model_id,
+                run_id=database.current_run_id.get(),
+                stage=current_stage.get(),
+                attempt=self.attempt,
+                succeeded=False,
+                candidate=self.candidate,
+                won=False if self.candidate is not None else None,
+            )
+
+        message: Message = {"role": msg["role"], "content": msg["content"] or ""}
+        self.history.append(message)
+        self.latest_message_id = database.writer.insert(
+            database.Message, conversation_id=self.conversation_id, **message
+        )
         return None
 
     def __repr__(self) -> str:
         return f"<PolarsLLM(name={self.name})>"
 
-    def make_modelfile(self, base_model: str):
-        system_msg = (
+    def make_system_message(self) -> str:
+        return (
             f"You are an expert in {self.expertise}. "
-            f"{SYSTEM_MESSAGE_CSV_REQS}"
-            f"The fields and data types required are: {format_pandera_model_as_instruction(self.schema)}"
+            f"{SYSTEM_MESSAGE_JSON_REQS if self.output_format == 'json' else SYSTEM_MESSAGE_CSV_REQS}"
+            f"The fields and data types required are: {self.compiled_schema.instruction}"
         )
 
-        return format_modelfile(base_model=base_model, system_msg=system_msg)
+    @property
+    def format(self) -> str | dict[str, Any]:
+        """Ollama's `format` for replies, the json schema of the model in json mode"""
+        if self.output_format == "json":
+            return self.compiled_schema.json_schema
+        return ""
 
     def parse_reply(self, reply: pl.DataFrame) -> pl.DataFrame:
-        return self.reply_parser(reply).select(self.schema_cols)
+        filled = [pl.lit(value).alias(column) for column, value in self.filled.items()]
+        return self.reply_parser(reply.with_columns(filled)).select(
+            self.compiled_schema.columns
+        )
 
     def get_response(self) -> Mapping[str, Any]:
-        response = ollama.chat(
-            model=self.name, messages=self.message_history, tools=self.formatted_tools
-        )
-        self.record_message(response["message"])
-        self.record_response(response)  # response holds the metadata of the message
+        messages = self.message_history
+        self.reply_cache_key = None
+        self.uncached_reply = None
 
-        return response
+        cached = False
+        if self.cache is None:
+            response = self.chat(messages)
+        else:
+            key = make_cache_key(
+                base_model=self.base_model,
+                modelfile=self.modelfile,
+                messages=messages,
+                tools=self.formatted_tools,
+                options=self.options,
+            )
+            response = self.cache.get(key)
+            cached = response is not None
+            if response is None:
+                response = self.chat(messages)
+                if response["message"].get("tool_calls"):
+                    # tool calls aren't checked, so there's nothing to wait for
+                    self.cache.put(key, response)
+                elif response.get("done_reason") != STREAM_ABORTED_DONE_REASON:
+                    self.uncached_reply = response
+            if cached or self.uncached_reply is not None:
+                self.reply_cache_key = key
 
-    def record_response(self, response: Mapping[str, Any]) -> None:
-        database.session.add(
-            database.Response(
-                **{
-                    field: value
-                    for field, value in response.items()
-                    if field
-                    in [
-                        "done_reason",
-                        "eval_count",
-                        "eval_duration",
-                        "load_duration",
-                        "prompt_eval_count",
-                        "prompt_eval_duration",
-                        "total_duration",
-                    ]
-                },
-                message_id=self.current_conversation.messages[-1].id,
+        self.record_message(response["message"])
+        # response holds the metadata of the message
+        estimated_prompt_tokens = None
+        if response.get("done_reason") != STREAM_ABORTED_DONE_REASON:
+            # the model's own system message is part of the prompt too
+            estimated_prompt_tokens = estimate_tokens(messages) + (
+                0 if self.sends_system_message else self.history.system_tokens
             )
+        self.record_response(
+            response, cached=cached, estimated_prompt_tokens=estimated_prompt_tokens
         )
-        database.session.commit()
-        return None
 
-    def send_message(self, role: Role, message: str) -> Mapping[str, Any]:
-        formatted_message = self.format_message(role=role, message=message)
-        self.record_message(formatted_message)
-
-        return self.get_response()
+        return response
 
-    def format_tools(self) -> Sequence[Tool]:
-        return [format_tool(tool) for tool in self.callable_tools.values()]
+    def update_cache(self, valid: bool) -> None:
+        """Caches the latest reply once it's known to be `valid`. Invalid replies
+        aren't cached (and are removed if they were cached before replies were
+        checked), so asking again in a new conversation gets a new reply."""
+        if self.cache is None or self.reply_cache_key is None:
+            return None
 
-    def format_message(self, role: Role, message: str) -> Message:
-        return {"role": role, "content": message}
+        if valid and self.uncached_reply is not None:
+            self.cache.put(self.reply_cache_key, self.uncached_reply)
+        elif not valid and self.uncached_reply is None:
+            self.cache.discard(self.reply_cache_key)
 
-    def generate_data(
-        self, start_new_conversation: bool = False, **kwargs
-    ) -> pl.DataFrame:
-        if start_new_conversation and (len(self.current_conversation.messages) > 0):
-            self.start_conversation()
+        self.reply_cache_key = None
+        self.uncached_reply = None
+        return None
 
-        num_attempts = -1
-        while num_attempts < DEFAULT_ATTEMPTS:
-            num_attempts += 1
-            question = self.questioner(**kwargs)
-            if num_attempts >= 1:
-                logger.warning(
-                    f"could not generate data after {DEFAULT_RETRIES}, restarting conversation"
-                )
-                self.start_conversation()
+    def chat(self, messages: list[Message]) -> Mapping[str, Any]:
+        if self.stream:
+            return self.stream_chat(messages)
+
+        return client_pool.chat(
+            model=self.ollama_model,
+            messages=messages,
+            tools=self.formatted_tools,
+            format=self.format,
+            options=self.options,
+            keep_alive=self.keep_alive,
+        )
 
-            num_retries = -1
-            reply = ""
-            while num_retries < DEFAULT_RETRIES:
-                num_retries += 1
+    def stream_chat(self, messages: list[Message]) -> Mapping[str, Any]:
+        """Streams the response, checking the csv header as soon as it arrives and
+        stopping generation if it is wrong."""
+        started = time.perf_counter_ns()
+        chunks = client_pool.chat(
+            model=self.ollama_model,
+            messages=messages,
+            tools=self.formatted_tools,
+            format=self.format,
+            options=self.options,
+            keep_alive=self.keep_alive,
+            stream=True,
+        )
 
-                if num_retries >= 1:
-                    logger.warning(
-                        f"bad attempt! {num_attempts=}, {num_retries=}\n\nreply:\n{reply}\n\nfollow up question: {question}"
-                    )
-                else:
-                    logger.info(f"question: {question}")
+        content = ""
+        tool_calls: list = []
+        num_chunks = 0
+        # json replies are constrained by the schema, so have no header to check
+        header_checked = self.output_format == "json"
+        for chunk in chunks:
+            if self.cancelled is not None and self.cancelled.is_set():
+                # closing the stream drops the connection, which stops generation
+                if hasattr(chunks, "close"):
+                    chunks.close()
+                self.check_cancelled()
+
+            num_chunks += 1
+            content += chunk["message"]["content"]
+            tool_calls.extend(chunk["message"].get("tool_calls") or [])
+
+            if chunk["done"]:
+                message: Message = {"role": "assistant", "content": content}
+                if tool_calls:
+                    message["tool_calls"] = tool_calls
+                return {**chunk, "message": message}
+
+            if header_checked:
+                continue
 
-                response = self.send_message("user", question)
+            header = find_csv_header(content, self.compiled_schema.columns)
+            if header is None:
+                header_checked = content.count("\n") >= HEADER_SEARCH_LINES
+                continue
 
-                if response["message"].get("tool_calls"):
-                    response = self.use_tools(response["message"]["tool_calls"])
+            header_checked = True
+            column_check = self.check_reply_columns(format_first_line_of_csv(header))
+            if self.header_feedback(column_check) is None:
+                continue
 
-                response_message = response["message"]
+            # closing the stream drops the connection, which stops generation
+            if hasattr(chunks, "close"):
+                chunks.close()
+            logger.warning(f"{self} stopped generation after bad header: {header}")
+            return {
+                "model": self.name,
+                "message": {"role": "assistant", "content": content},
+                "done": True,
+                "done_reason": STREAM_ABORTED_DONE_REASON,
+                "eval_count": num_chunks,
+                "eval_duration": 0,
+                "load_duration": 0,
+                "prompt_eval_count": 0,
+                "prompt_eval_duration": 0,
+                "total_duration": time.perf_counter_ns() - started,
+            }
+
+        raise Exception(f"{self} response stream ended before it was done")
+
+    def record_response(
+        self,
+        response: Mapping[str, Any],
+        cached: bool = False,
+        estimated_prompt_tokens: int | None = None,
+    ) -> None:
+        self.latest_response_id = database.writer.insert(
+            database.Response,
+            cached=cached,
+            estimated_prompt_tokens=estimated_prompt_tokens,
+            **{
+                field: value
+                for field, value in response.items()
+                if field
+                in [
+                    "done_reason",
+                    "eval_count",
+                    "eval_duration",
+                    "load_duration",
+                    "prompt_eval_count",
+                    "prompt_eval_duration",
+                    "total_duration",
+                ]
+            },
+            message_id=self.latest_message_id,
+        )
+        return None
 
-                # if response has multiple paragraphs, assume that csv is the largest
-                # one
-                response_segments = response_message["content"].split("\n\n")
-                response_segment = ""
-                for segment in response_segments:
-                    if len(segment) > len(response_segment):
-                        response_segment = segment
+    def send_message(self, role: Role, message: str) -> Mapping[str, Any]:
+        self.check_cancelled()
+        formatted_message = self.format_message(role=role, message=message)
+        self.record_message(formatted_message)
 
-                reply = format_first_line_of_csv(response_segment)
+        return self.get_response()
 
-                column_check = self.check_reply_columns(reply)
+    def format_tools(self) -> Sequence[Tool]:
+        return [format_tool(tool) for tool in self.tool_executor.callables.values()]
 
-                if not column_check.correct:
-                    question = (
-                        "The first row did not look correct. "
-                        f"It should only have the column names: {','.join(self.schema_cols)}"
-                    )
-                    continue
+    def format_message(self, role: Role, message: str) -> Message:
+        return {"role": role, "content": message}
 
-                if column_check.missing:
-                    question = f"That was incorrect. The first row was missing these columns: {', '.join(column_check.missing)}. "
+    def check_reply(self, response: Mapping[str, Any]) -> pl.DataFrame | Feedback:
+        """The validated dataframe in a reply, or what was wrong with it"""
+        from pandera.errors import SchemaErrors
 
-                    if column_check.extra:
-                        # this might confuse it, telling the model only the wrong
-                        # columns seems to be more reliable?
-                        # question += f"Additionally the following column names were not recognized: {column_check.extra}"
-                        pass
+        response_message = response["message"]
+        reply = response_message["content"]
 
-                    continue
+        if response.get("done_reason") == STREAM_ABORTED_DONE_REASON:
+            # generation was stopped as soon as a bad header was streamed
+            header = format_first_line_of_csv(
+                find_csv_header(reply, self.compiled_schema.columns) or ""
+            )
+            feedback = self.header_feedback(self.check_reply_columns(header))
+            return Feedback("header", feedback or "", reply)
+
+        if self.output_format == "json":
+            try:
+                reply_df = polars_from_json_string(reply, self.compiled_schema.dtypes)
+            except (
+                ValueError,
+                KeyError,
+                TypeError,
+                pl.exceptions.PolarsError,
+            ) as e:
+                return Feedback(
+                    "json", f"The reply could not be read as JSON rows: {e}", reply
+                )
 
-                lines = reply.splitlines()
-                if any([line.startswith(",") for line in lines]):
-                    question = "There were some lines that started with a comma, this is incorrect"
-                    continue
+            feedback = self.header_feedback(
+                self.check_reply_columns(",".join(reply_df.columns))
+            )
+            if feedback is not None:
+                return Feedback("header", feedback, reply)
 
-                if any([line.count('"') % 2 for line in lines]):
-                    question = "There were some lines with an odd number of quotation marks, please only quote string fields."
-                    continue
+            try:
+                parsed = self.parse_reply(reply_df)
+            except Exception as e:
+                return Feedback("parse", str(e), reply)
 
-                try:
-                    parsed = self.parse_reply(polars_from_csv_string(reply))
-                except pl.exceptions.ComputeError as e:
-                    if "truncate_ragged_lines" in str(e):
-                        question = "Some lines had an incorrect amount of delimiters!"
-                    else:
-                        breakpoint()
-                        question = str(e)
+        else:
+            # fix what can be fixed without asking again
+            reply, fixes = repair_csv(reply)
+            if fixes:
+                logger.info(f"{self} repaired reply: {', '.join(fixes)}")
+                database.writer.update(
+                    database.Response,
+                    self.latest_response_id,
+                    repairs=",".join(fixes),
+                )
 
-                    continue
+            feedback = self.header_feedback(self.check_reply_columns(reply))
+            if feedback is not None:
+                return Feedback("header", feedback, reply)
 
-                except Exception as e:
-                    breakpoint()
-                    question = str(e)
-                    continue
+            lines = reply.splitlines()
+            if any([line.startswith(",") for line in lines]):
+                return Feedback(
+                    "leading_comma",
+                    "There were some lines that started with a comma, this is incorrect",
+                    reply,
+                )
 
-                try:
-                    result = self.schema.validate(parsed, lazy=True)
-                    logger.info(
-                        f"success after {num_retries=}, {num_attempts=}! generated: {result}"
+            try:
+                parsed = self.parse_reply(polars_from_csv_string(reply))
+            except pl.exceptions.ComputeError as e:
+                if "truncate_ragged_lines" in str(e):
+                    return Feedback(
+                        "ragged_lines",
+                        "Some lines had an incorrect amount of delimiters!",
+                        reply,
                     )
-                    return result
-
-                except SchemaErrors as e:
-                    question = "\n".join(str(err) for err in e.schema_errors)
-                    continue
+                logger.exception(f"{self} could not parse reply")
+                return Feedback("parse", str(e), reply)
 
-        raise Exception(f"Could not generate data for {self.model.name}")
+            except Exception as e:
+                logger.exception(f"{self} could not parse reply")
+                return Feedback("parse", str(e), reply)
 
-    def get_tool(self, name: str) -> database.Tool:
-        tool = database.session.query(database.Tool).filter_by(name=name).first()
-
-        if not tool:
-            # llm hallucinated for the first time, create it
-            tool = database.Tool(
-                model_id=self.model.id, name=name, is_hallucination=True
+        try:
+            return validate(parsed, self.compiled_schema)
+        except SchemaErrors as e:
+            return Feedback(
+                "schema", "\n".join(str(err) for err in e.schema_errors), reply
             )
-            database.session.add(tool)
-            database.session.commit()
-
-        return tool
-
-    def record_hallucinated_tool_call(
-        self, tool: database.Tool, call_args: dict
-    ) -> None:
-        breakpoint()
 
-        return None
-
-    def use_tool(self, name: str, call_args: dict) -> None:
-        tool = self.get_tool(name)
-
-        tool_call = database.ToolCall(
-            tool_id=tool.id,
-            arguments=call_args,
-            message_id=self.latest_message.id,
-        )
-        database.session.add(tool_call)
-        database.session.commit()
-
-        # special case if hallucinated
-        if tool.is_hallucination:
-            tool_result = database.ToolResult(
-                call_id=tool_call.id, was_error=True, value_or_error="Hallucination"
-            )
+    def generate_data(
+        self, start_new_conversation: bool = False, **kwargs
+    ) -> pl.DataFrame:
+        """Asks the question made by the questioner from `kwargs`, until a reply is
+        a valid dataframe. After a bad reply, the retry policy decides whether to
+        ask again with feedback, restart the conversation, or give up."""
+        if start_new_conversation and (len(self.history) > 0):
+            self.start_conversation()
 
-            database.session.add(tool_result)
-            database.session.commit()
-            return None
+        if self.candidates > 1:
+            return self.race(**kwargs)
+
+        question = self.questioner(**kwargs)
+        logger.info(f"question: {question}")
+        attempt = 0
+        retries = 0
+        while True:
+            response = self.send_message("user", question)
+
+            if response["message"].get("tool_calls"):
+                response = self.use_tools(response["message"]["tool_calls"])
+
+            checked = self.check_reply(response)
+            self.update_cache(valid=isinstance(checked, pl.DataFrame))
+            if isinstance(checked, pl.DataFrame):
+                logger.info(f"success after {retries=}, {attempt=}! generated: {checked}")
+                database.writer.update(
+                    database.Response, self.latest_response_id, outcome=VALID
+                )
+                database.writer.update(
+                    database.Conversation, self.conversation_id, succeeded=True
+                )
+                return checked
 
-        # attempt to run tool
-        try:
-            result = self.callable_tools[name](**call_args)
-        except Exception as e:
-            tool_result = database.ToolResult(
-                call_id=tool_call.id, was_error=True, value_or_error=str(e)
+            database.writer.update(
+                database.Response, self.latest_response_id, outcome=checked.failure
             )
-        else:
-            tool_result = database.ToolResult(
-                call_id=tool_call.id, was_error=False, value_or_error=str(result)
+            action = self.retry_policy.decide(
+                expert_of(self.name), checked.failure, retries, attempt
             )
+            if action == "retry":
+                retries += 1
+                question = checked.question
+                logger.warning(
+                    f"bad attempt! {attempt=}, {retries=}\n\nreply:\n{checked.reply}\n\nfollow up question: {question}"
+                )
+            elif action == "restart":
+                logger.warning(
+                    f"could not generate data after {retries=}, restarting conversation"
+                )
+                attempt += 1
+                retries = 0
+                self.start_conversation(attempt=attempt)
+                question = self.questioner(**kwargs)
+            else:
+                logger.warning(f"{self} gave up after {retries=}, {attempt=}")
+                break
 
-        database.session.add(tool_result)
-        database.session.commit()
-        return None
+        raise Exception(f"Could not generate data for {self.name}")
 
-    def use_tools(self, calls=list[dict]) -> Message:
-        for call in calls:
-            self.use_tool(
-                name=call["function"]["name"], call_args=call["function"]["arguments"]
+    def generate_pages(
+        self,
+        total_rows: int,
+        key_columns: Sequence[str],
+        seen: pl.DataFrame | None = None,
+        **kwargs,
+    ) -> Iterator[pl.DataFrame]:
+        """Generates a table too large for one reply, a page at a time, yielding
+        each page once it is validated.
+
+        Every page is asked for in a new conversation, with the question followed by
+        the latest keys so far. Rows whose `key_columns` were already generated,
+        including those in `seen`, are dropped. Only the keys are kept in memory.
+        """
+        key_columns = list(key_columns)
+        if seen is None:
+            seen = pl.DataFrame(schema={key: pl.String for key in key_columns})
+        seen = seen.select(key_columns).cast(pl.String)
+
+        rows_done = 0
+        stalled_pages = 0
+        while rows_done < total_rows:
+            page_expert = self.fork()
+            question = self.questioner(**kwargs)
+            if seen.height:
+                recent_keys = seen.tail(MAX_KEYS_IN_CONTINUATION)
+                continuation = PAGE_CONTINUATION.format(
+                    rows_done=seen.height,
+                    key_names=", ".join(key_columns),
+                    recent_keys="; ".join(
+                        ", ".join(row) for row in recent_keys.iter_rows()
+                    ),
+                )
+                page_expert.questioner = lambda **_: f"{question}\n{continuation}"
+
+            page = page_expert.generate_data(**kwargs)
+            page_keys = page.select(pl.col(key_columns).cast(pl.String))
+            new_rows = (
+                page.with_columns(page_keys)
+                .unique(subset=key_columns, keep="first", maintain_order=True)
+                .join(seen, on=key_columns, how="anti")
+                .head(total_rows - rows_done)
             )
+            if new_rows.height < page.height:
+                logger.warning(
+                    f"{self} dropped {page.height - new_rows.height} repeated rows"
+                )
 
-        response = self.send_tool_results()
+            if new_rows.is_empty():
+                stalled_pages += 1
+                if stalled_pages >= MAX_STALLED_PAGES:
+                    logger.warning(
+                        f"{self} stopped after {rows_done} of {total_rows} rows, "
+                        f"{stalled_pages} pages in a row had no new rows"
+                    )
+                    return
+                continue
 
-        return response
+            stalled_pages = 0
+            rows_done += new_rows.height
+            seen = pl.concat([seen, new_rows.select(key_columns)])
+            logger.info(f"{self} generated {rows_done} of {total_rows} rows")
+            yield new_rows
 
-    def send_tool_results(self) -> Mapping[str, Any]:
-        calls = database.session.query(database.ToolCall).filter_by(
-            message_id=self.latest_message.id
+    def generate_data_concurrently(
+        self,
+        questions: Sequence[dict[str, Any]],
+        max_concurrency: int = DEFAULT_CONCURRENCY,
+        on_result: Callable[[int, pl.DataFrame], None] | None = None,
+        filled: Sequence[Mapping[str, Any]] | None = None,
+    ) -> list[pl.DataFrame]:
+        """Generate a dataframe for each set of questioner kwargs in `questions`.
+
+        Each question is asked in a forked conversation, with at most
+        `max_concurrency` in flight at once. Results are in the same order as
+        `questions`. `on_result` is called with the index of each question and its
+        dataframe as soon as it's generated, even if another question fails.
+        `filled` are the columns to fill in for each question, see `filling`.
+        """
+        logger.info(
+            f"{self} generating {len(questions)} dataframes with {max_concurrency=}"
+        )
+        # each question runs in a copy of this context, so it's recorded against
+        # the same run and stage
+        contexts = [copy_context() for _ in questions]
+
+        def ask(index: int, kwargs: dict[str, Any]) -> pl.DataFrame:
+            expert = self.filling(**filled[index]) if filled else self.fork()
+            result = contexts[index].run(lambda: expert.generate_data(**kwargs))
+            if on_result is not None:
+                on_result(index, result)
+            return result
+
+        with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+            return list(pool.map(ask, range(len(questions)), questions))
+
+    def use_tools(self, calls=list[dict]) -> Mapping[str, Any]:
+        results = self.tool_executor.run(calls, message_id=self.latest_message_id)
+
+        # dont provide results from hallucinated tools
+        return self.send_message(
+            role="tool",
+            message="\n".join(result for result in results if result is not None),
         )
 
-        formatted_responses = []
-        for call in calls:
-            name = call.tool.name
-            result = call.result
-            if result.is_hallucination:
-                # dont provide results from hallucinated tools
-                continue
-
-            formatted_args = ", ".join(
-                f"{k}={repr(v)}" for k, v in call.arguments.items()
-            )
-            formatted_responses.append(
-                f"{name}({formatted_args}) = {result.value_or_error}"
+    @property
+    def schema_cols(self) -> frozenset[str]:
+        return self.compiled_schema.column_set
+
+    def header_feedback(self, column_check: ColumnCheck) -> str | None:
+        """Question to ask the LLM if the header was wrong, otherwise None"""
+        if not column_check.correct:
+            return (
+                "The first row did not look correct. "
+                f"It should only have the column names: {','.join(self.compiled_schema.columns)}"
             )
 
-        return self.send_message(role="tool", message="\n".join(formatted_responses))
+        if column_check.missing:
+            # telling the model about extra columns as well might confuse it,
+            # telling the model only the wrong columns seems to be more reliable?
+            return f"That was incorrect. The first row was missing these columns: {', '.join(column_check.missing)}. "
 
-    @property
-    def schema_cols(self) -> set[str]:
-        return set(self.schema.to_schema().columns.keys())
+        return None
 
     def check_reply_columns(self, reply: str) -> ColumnCheck:
         reply_cols: set[str] = set(reply.lower().split("\n")[0].split(","))
@@ -434,7 +893,7 @@ class PolarsLLM:
 
         return ColumnCheck(
             correct=expected_cols & reply_cols,
-            missing=expected_cols - reply_cols,
+            missing=expected_cols - reply_cols - self.filled.keys(),
             extra=reply_cols - expected_cols,
         )
 
@@ -455,16 +914,31 @@ def polars_from_csv_string(csv_string: str) -> pl.DataFrame:
     )
 
 
-def format_pandera_model_as_instruction(model: Type[DataFrameModel]) -> str:
-    dtypes = model.to_schema().dtypes
-    result = "; ".join(
-        [
-            f"{col_name}={type(dtype).__name__.rstrip(string.digits).lower()}"
-            for col_name, dtype in dtypes.items()
-        ]
-    )
+def polars_from_json_string(
+    json_string: str, dtypes: Mapping[str, pl.DataType]
+) -> pl.DataFrame:
+    """Reads the `rows` of a json reply. Numeric fields are read as their dtype, as
+    the LLM may write 1 for 1.0"""
+    rows = json.loads(json_string)["rows"]
+    numeric = {name: dtype for name, dtype in dtypes.items() if dtype.is_numeric()}
+    return pl.from_dicts(rows, schema_overrides=numeric, infer_schema_length=None)
+
+
+def find_csv_header(content: str, columns: Sequence[str]) -> str | None:
+    """Finds the first complete line that could be a csv header for `columns`, as
+    it has as many fields or shares a column name. Blank lines, code fences and
+    lead-ins like 'Here is the data:' or 'Sure, here you go.' are skipped. None if
+    there isn't one in the first `HEADER_SEARCH_LINES` lines (yet)."""
+    *complete_lines, _ = content.split("\n")
+    for line in complete_lines[:HEADER_SEARCH_LINES]:
+        line = line.strip()
+        if "," not in line or line.startswith("```") or line.endswith(":"):
+            continue
+        fields = format_first_line_of_csv(line).split(",")
+        if len(fields) == len(columns) or not set(fields).isdisjoint(columns):
+            return line
 
-    return result
+    return None
 
 
 def format_first_line_of_csv(csv_string: str) -> str:
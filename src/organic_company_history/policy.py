@@ -0,0 +1,245 @@
+"""python -m organic_company_history.policy
+
+Choosing whether to ask again, restart the conversation, or give up after a bad reply.
+"""
+from __future__ import annotations
+import argparse
+from typing import Literal, NamedTuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import polars as pl
+
+DEFAULT_ATTEMPTS = 2
+"""Number of times to completely do over regeneration (if retries dont work)"""
+
+DEFAULT_RETRIES = 3
+"""Number of retries to regenerate a valid dataframe (using feedback)"""
+
+MAX_ADAPTIVE_ATTEMPTS = 4
+MAX_ADAPTIVE_RETRIES = 6
+"""Most restarts and retries the adaptive policy will make, when history says
+they're worth it"""
+
+MIN_SAMPLES = 10
+"""Replies an estimate needs before it is trusted over the default policy"""
+
+MIN_SUCCESS_RATE = 0.05
+"""Questions are given up on when no action is more likely than this to work"""
+
+Failure = Literal[
+    "header", "leading_comma", "ragged_lines", "json", "parse", "schema"
+]
+"""Why a reply couldn't be turned into a valid dataframe"""
+
+Action = Literal["retry", "restart", "abandon"]
+"""retry - ask again with feedback. restart - ask the original question in a new
+conversation. abandon - give up on the question"""
+
+VALID = "valid"
+"""Outcome recorded for replies that were valid dataframes"""
+
+
+def expert_of(model_name: str) -> str:
+    """The expert a model is for, without its industry, e.g. timesheet-peon"""
+    return model_name.rsplit("/", 1)[-1]
+
+
+class Estimate(NamedTuple):
+    samples: int
+    successes: int
+    seconds: float
+    """Mean seconds taken by a reply"""
+
+    @property
+    def success_rate(self) -> float:
+        # smoothed, so a few lucky (or unlucky) replies aren't taken as certain
+        return (self.successes + 1) / (self.samples + 2)
+
+    @property
+    def expected_seconds(self) -> float:
+        """Seconds until a valid reply, if the action is repeated until it works"""
+        return self.seconds / self.success_rate
+
+
+class RetryPolicy:
+    """Retries with feedback `max_retries` times, then restarts the conversation,
+    giving up after `max_attempts` restarts"""
+
+    max_retries: int
+    max_attempts: int
+
+    def __init__(
+        self, max_retries: int = DEFAULT_RETRIES, max_attempts: int = DEFAULT_ATTEMPTS
+    ) -> None:
+        self.max_retries = max_retries
+        self.max_attempts = max_attempts
+
+    def __repr__(self) -> str:
+        return (
+            f"<{type(self).__name__}(max_retries={self.max_retries}, "
+            f"max_attempts={self.max_attempts})>"
+        )
+
+    def decide(
+        self, expert: str, failure: Failure, retries: int, attempt: int
+    ) -> Action:
+        """What to do after `expert`'s reply failed with `failure`, having retried
+        `retries` times in this conversation, which is restart number `attempt`"""
+        if retries < self.max_retries:
+            return "retry"
+        if attempt < self.max_attempts:
+            return "restart"
+        return "abandon"
+
+
+class AdaptiveRetryPolicy(RetryPolicy):
+    """Chooses the action with the least expected time to a valid reply, from the
+    success rate and time taken by each expert's replies in earlier runs:
+    - retrying, from the replies that followed a reply with the same failure
+    - restarting, from the first replies of conversations
+
+    Falls back to the default policy for experts and failures without enough
+    history, and gives up early when neither action is likely to work."""
+
+    fresh: dict[str, Estimate]
+    """Estimates for the first reply of a conversation, by expert"""
+    after: dict[tuple[str, str], Estimate]
+    """Estimates for the reply after a failure, by expert and failure"""
+    default: RetryPolicy
+
+    def __init__(
+        self,
+        fresh: dict[str, Estimate],
+        after: dict[tuple[str, str], Estimate],
+        max_retries: int = MAX_ADAPTIVE_RETRIES,
+        max_attempts: int = MAX_ADAPTIVE_ATTEMPTS,
+        default: RetryPolicy | None = None,
+    ) -> None:
+        super().__init__(max_retries=max_retries, max_attempts=max_attempts)
+        self.fresh = fresh
+        self.after = after
+        self.default = default or RetryPolicy()
+
+    @classmethod
+    def from_database(cls, **kwargs) -> AdaptiveRetryPolicy:
+        """Learns from every response recorded in the configured database"""
+        from .report import load_responses
+
+        return cls(*estimate_outcomes(load_responses()), **kwargs)
+
+    def decide(
+        self, expert: str, failure: Failure, retries: int, attempt: int
+    ) -> Action:
+        fresh = self.fresh.get(expert)
+        after = self.after.get((expert, failure))
+        if (
+            fresh is None
+            or after is None
+            or min(fresh.samples, after.samples) < MIN_SAMPLES
+        ):
+            return self.default.decide(expert, failure, retries, attempt)
+
+        choices: dict[Action, Estimate] = {}
+        if retries < self.max_retries:
+            choices["retry"] = after
+        if attempt < self.max_attempts:
+            choices["restart"] = fresh
+
+        if not choices:
+            return "abandon"
+
+        action = min(choices, key=lambda action: choices[action].expected_seconds)
+        if choices[action].success_rate < MIN_SUCCESS_RATE:
+            return "abandon"
+        return action
+
+
+def estimate_outcomes(
+    responses: pl.DataFrame,
+) -> tuple[dict[str, Estimate], dict[tuple[str, str], Estimate]]:
+    """Estimates for `AdaptiveRetryPolicy` from `report.load_responses`. Cached
+    responses, and replies that weren't checked (like tool calls), are left out."""
+    import polars as pl
+    from .report import NANOSECONDS
+
+    replies = (
+        responses.filter(pl.col("outcome").is_not_null() & ~pl.col("cached"))
+        .sort("response_id")
+        .with_columns(
+            valid=pl.col("outcome") == VALID,
+            seconds=pl.col("total_duration") / NANOSECONDS,
+            first=pl.col("response_id")
+            == pl.col("response_id").min().over("conversation_id"),
+        )
+        .with_columns(
+            next_valid=pl.col("valid").shift(-1).over("conversation_id"),
+            next_seconds=pl.col("seconds").shift(-1).over("conversation_id"),
+        )
+    )
+
+    fresh = (
+        replies.filter(pl.col("first"))
+        .group_by("expert")
+        .agg(
+            samples=pl.len(),
+            successes=pl.col("valid").sum(),
+            seconds=pl.col("seconds").mean(),
+        )
+    )
+    after = (
+        replies.filter(~pl.col("valid") & pl.col("next_valid").is_not_null())
+        .group_by("expert", "outcome")
+        .agg(
+            samples=pl.len(),
+            successes=pl.col("next_valid").sum(),
+            seconds=pl.col("next_seconds").mean(),
+        )
+    )
+
+    return (
+        {
+            row["expert"]: Estimate(row["samples"], row["successes"], row["seconds"])
+            for row in fresh.iter_rows(named=True)
+        },
+        {
+            (row["expert"], row["outcome"]): Estimate(
+                row["samples"], row["successes"], row["seconds"]
+            )
+            for row in after.iter_rows(named=True)
+        },
+    )
+
+
+if __name__ == "__main__":
+    import polars as pl
+    from . import database
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[-1])
+    parser.add_argument(
+        "--database",
+        type=str,
+        default=database.DB_NAME,
+        help="The sqlite file conversations were stored in.",
+    )
+    args = parser.parse_args()
+
+    database.configure(args.database)
+    policy = AdaptiveRetryPolicy.from_database()
+    rows = [
+        {
+            "expert": expert,
+            "failure": failure,
+            "retry_success_rate": estimate.success_rate,
+            "retry_seconds": estimate.expected_seconds,
+            "restart_success_rate": policy.fresh[expert].success_rate,
+            "restart_seconds": policy.fresh[expert].expected_seconds,
+            "samples": estimate.samples,
+            "action": policy.decide(expert, failure, retries=0, attempt=0),
+        }
+        for (expert, failure), estimate in sorted(policy.after.items())
+        if expert in policy.fresh
+    ]
+    with pl.Config(
+        tbl_rows=-1, tbl_cols=-1, tbl_width_chars=200, float_precision=2
+    ):
+        print(pl.DataFrame(rows))
@@ -0,0 +1,59 @@
+"""Creating ollama models, reusing any that already exist with the same modelfile"""
+import hashlib
+import threading
+from loguru import logger
+from .clients import client_pool
+
+DIGEST_LENGTH = 12
+"""Number of characters of the modelfile hash used to tag models"""
+
+
+def modelfile_digest(modelfile: str) -> str:
+    return hashlib.sha256(modelfile.encode("utf-8")).hexdigest()[:DIGEST_LENGTH]
+
+
+class ModelRegistry:
+    """Tags models with a hash of their modelfile, so a model is only created
+    when its modelfile has changed."""
+
+    _existing: set[str] | None
+
+    def __init__(self) -> None:
+        self._existing = None
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"<ModelRegistry(existing={self._existing})>"
+
+    def refresh(self) -> set[str]:
+        """Reloads the names of models that every ollama host already has"""
+        self._existing = client_pool.list()
+        return self._existing
+
+    def get_or_create(self, name: str, modelfile: str) -> str:
+        """Returns the tagged name of a model for `modelfile`, creating it if needed"""
+        import ollama
+
+        tagged_name = f"{name}:{modelfile_digest(modelfile)}"
+        with self._lock:
+            if self._existing is None:
+                self.refresh()
+
+            if tagged_name in self._existing:
+                logger.info(f"reusing model {tagged_name}")
+                return tagged_name
+
+            try:
+                client_pool.create(model=tagged_name, modelfile=modelfile)
+            except ollama.ResponseError:
+                # could have been created by another process since we checked
+                if tagged_name not in self.refresh():
+                    raise
+
+            logger.info(f"created model {tagged_name}")
+            self._existing.add(tagged_name)
+
+        return tagged_name
+
+
+model_registry = ModelRegistry()
@@ -0,0 +1,158 @@
+"""Fixing the mistakes LLMs commonly make when writing a csv, so that a reply can
+be parsed without asking the LLM to try again"""
+from typing import Literal, NamedTuple
+import re
+import polars as pl
+
+Fix = Literal[
+    "code_fence",
+    "largest_segment",
+    "lead_in",
+    "header",
+    "spaced_delimiters",
+    "odd_quotes",
+    "leading_comma",
+    "trailing_comma",
+    "truncated_last_line",
+]
+
+CODE_FENCE = re.compile(r"^\s*(?:```(?:[\w+-]+(?=\s|$))?|<\|python_tag\|>)\s*")
+"""A code fence (with its language, e.g. ```csv) or tool tag at the start of a line"""
+
+QUOTED_FIELD = r'"[^"]*"'
+
+
+class RepairedCsv(NamedTuple):
+    csv: str
+    fixes: tuple[Fix, ...]
+    """The fixes that changed the reply, in the order they were applied"""
+
+
+def count_commas(line: str) -> int:
+    return re.sub(QUOTED_FIELD, "", line).count(",")
+
+
+def select_csv_lines(content: str) -> tuple[list[str], list[Fix]]:
+    """The lines of the csv in a reply, dropping code fences and any prose around
+    the csv. When the reply has several paragraphs, the csv is assumed to be the
+    one with the most commas. The header is the first line with as many commas as
+    the row after it, so lead-ins like 'Sure, here you go.' are dropped too."""
+    fixes: list[Fix] = []
+
+    lines = content.strip().splitlines()
+    # fences are stripped from the start of lines, lines that are only a fence
+    # are dropped
+    unfenced = [
+        CODE_FENCE.sub("", line)
+        for line in lines
+        if not CODE_FENCE.fullmatch(line)
+    ]
+    if unfenced != lines:
+        fixes.append("code_fence")
+
+    segments: list[list[str]] = [[]]
+    for line in unfenced:
+        if line.strip():
+            segments[-1].append(line)
+        elif segments[-1]:
+            segments.append([])
+
+    segments = [segment for segment in segments if segment]
+    if not segments:
+        return [], fixes
+
+    segment = max(segments, key=lambda lines: sum(line.count(",") for line in lines))
+    if len(segments) > 1:
+        fixes.append("largest_segment")
+
+    candidates = [
+        i
+        for i, line in enumerate(segment)
+        if "," in line and not line.rstrip().endswith(":")
+    ]
+    header_index = next(
+        (
+            i
+            for i in candidates
+            if i + 1 < len(segment)
+            and count_commas(segment[i]) == count_commas(segment[i + 1])
+        ),
+        candidates[0] if candidates else 0,
+    )
+    if header_index:
+        fixes.append("lead_in")
+
+    return segment[header_index:], fixes
+
+
+def format_header(header: str) -> str:
+    """lower_case_with_underscores column names, without quotes"""
+    return ",".join(
+        column.strip().strip('"').strip().lower().replace(" ", "_")
+        for column in header.split(",")
+    )
+
+
+def repair_csv(content: str) -> RepairedCsv:
+    """Applies every fix that is needed to make `content` a well formed csv.
+
+    Rows are fixed all at once with polars string expressions. Fixes that can't
+    be made safely, like a row in the middle of the csv with too many values,
+    are left for the LLM to correct."""
+    lines, fixes = select_csv_lines(content)
+    if not lines:
+        return RepairedCsv(csv="", fixes=tuple(fixes))
+
+    header, *rows = lines
+    formatted_header = format_header(header)
+    if formatted_header != header:
+        fixes.append("header")
+
+    num_fields = formatted_header.count(",") + 1
+    rows_df = pl.DataFrame({"row": rows}, schema={"row": pl.String}).with_columns(
+        stripped=pl.col("row").str.strip_chars()
+    )
+
+    if not rows_df.height:
+        return RepairedCsv(csv=formatted_header, fixes=tuple(fixes))
+
+    repaired = rows_df.with_columns(
+        pl.col("stripped").str.replace_all(r"\s*,\s*", ",").alias("row"),
+    ).with_columns(
+        odd_quotes=pl.col("row").str.count_matches('"') % 2 == 1,
+    ).with_columns(
+        pl.when(pl.col("odd_quotes"))
+        .then(pl.col("row").str.replace_all('"', ""))
+        .otherwise(pl.col("row")),
+    ).with_columns(
+        commas=pl.col("row").str.replace_all(QUOTED_FIELD, "").str.count_matches(","),
+    ).with_columns(
+        leading_comma=pl.col("row").str.starts_with(",")
+        & (pl.col("commas") == num_fields),
+        trailing_comma=pl.col("row").str.ends_with(",")
+        & (pl.col("commas") == num_fields),
+    ).with_columns(
+        pl.when(pl.col("leading_comma"))
+        .then(pl.col("row").str.strip_prefix(","))
+        .when(pl.col("trailing_comma"))
+        .then(pl.col("row").str.strip_suffix(","))
+        .otherwise(pl.col("row")),
+    )
+
+    # generation stopped part way through the last row
+    truncated_last_line = (
+        repaired["commas"][-1] < num_fields - 1 and repaired.height > 1
+    )
+    if truncated_last_line:
+        repaired = repaired.head(-1)
+
+    if repaired["stripped"].str.contains(r"\s,|,\s").any():
+        fixes.append("spaced_delimiters")
+    for fix in ("odd_quotes", "leading_comma", "trailing_comma"):
+        if repaired[fix].any():
+            fixes.append(fix)  # type: ignore[arg-type]
+    if truncated_last_line:
+        fixes.append("truncated_last_line")
+
+    csv = "\n".join([formatted_header, *repaired["row"]])
+    return RepairedCsv(csv=csv, fixes=tuple(fixes))
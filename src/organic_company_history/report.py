@@ -0,0 +1,197 @@
+"""python -m organic_company_history.report
+
+Token and latency accounting, from the metrics recorded with each response.
+"""
+import argparse
+from typing import Sequence
+import polars as pl
+from loguru import logger
+from . import database
+
+NANOSECONDS = 1e9
+
+GROUPINGS = (
+    "expert",
+    "model",
+    "output_format",
+    "stage",
+    "run_id",
+    "attempt",
+    "retry",
+)
+
+RESPONSES_QUERY = """
+select
+    responses.id as response_id,
+    messages.conversation_id,
+    models.name as model,
+    coalesce(models.output_format, 'csv') as output_format,
+    conversations.run_id,
+    runs.label as run_label,
+    conversations.stage,
+    conversations.attempt,
+    conversations.succeeded,
+    conversations.candidate,
+    conversations.won,
+    (
+        select count(*) from messages as earlier
+        where earlier.conversation_id = messages.conversation_id
+        and earlier.role = 'user'
+        and earlier.id < messages.id
+    ) - 1 as retry,
+    responses.done_reason,
+    responses.cached,
+    responses.repairs,
+    responses.outcome,
+    responses.prompt_eval_count,
+    responses.estimated_prompt_tokens,
+    responses.eval_count,
+    responses.prompt_eval_duration,
+    responses.eval_duration,
+    responses.load_duration,
+    responses.total_duration
+from responses
+join messages on messages.id = responses.message_id
+join conversations on conversations.id = messages.conversation_id
+join models on models.id = conversations.model_id
+left join runs on runs.id = conversations.run_id
+"""
+
+
+def load_responses(run_ids: Sequence[int] | None = None) -> pl.DataFrame:
+    """Every recorded response, with the expert, run, stage, attempt and retry it
+    was part of. `retry` is 0 for the answer to the original question."""
+    if database.writer.rows_failed:
+        logger.warning(
+            f"{database.writer.rows_failed} rows couldn't be written, "
+            "so some conversations are incomplete"
+        )
+    responses = database.read_query(
+        RESPONSES_QUERY,
+        {
+            **database.polars_schema(database.Conversation, database.Response),
+            "run_label": pl.String(),
+        },
+    )
+
+    if run_ids is not None:
+        responses = responses.filter(pl.col("run_id").is_in(run_ids))
+
+    return responses.with_columns(
+        pl.col("model").str.split("/").list.last().alias("expert"),
+        pl.col("succeeded").fill_null(False),
+        pl.col("cached").fill_null(False),
+    )
+
+
+def summarise(responses: pl.DataFrame, by: str | list[str] = "expert") -> pl.DataFrame:
+    """Tokens, time, throughput and retries, grouped `by` the given columns.
+
+    Cached responses don't count towards time taken. Time lost is the time spent
+    on replies that were not the final, valid, reply of a conversation.
+
+    Candidates are conversations raced against each other for the same question,
+    only one of each race wins, see `PolarsLLM.race`.
+
+    Reused prompt tokens are the tokens of each prompt that ollama didn't have to
+    evaluate, because an earlier prompt started the same way. The prompt's size is
+    only estimated, so they (and the prompt time they saved) are rough.
+    """
+    final_reply = pl.col("succeeded") & (
+        pl.col("retry") == pl.col("retry").max().over("conversation_id")
+    )
+    seconds = [
+        "prompt_eval_duration",
+        "eval_duration",
+        "load_duration",
+        "total_duration",
+    ]
+    turn = pl.struct("conversation_id", "retry")
+    reused_tokens = (
+        pl.when(pl.col("cached"))
+        .then(0)
+        .otherwise(pl.col("estimated_prompt_tokens") - pl.col("prompt_eval_count"))
+        .clip(lower_bound=0)
+    )
+
+    return (
+        responses.with_columns(
+            pl.when(pl.col("cached"))
+            .then(0)
+            .otherwise(pl.col(seconds) / NANOSECONDS)
+            .name.keep(),
+            final_reply.alias("final_reply"),
+        )
+        .group_by(by)
+        .agg(
+            pl.len().alias("responses"),
+            pl.col("cached").sum().alias("cache_hits"),
+            pl.col("repairs").is_not_null().sum().alias("repaired"),
+            pl.col("conversation_id").n_unique().alias("conversations"),
+            pl.col("conversation_id")
+            .filter(pl.col("succeeded"))
+            .n_unique()
+            .alias("successes"),
+            turn.filter(pl.col("retry") > 0).n_unique().alias("retries"),
+            pl.col("conversation_id")
+            .filter(pl.col("candidate").is_not_null())
+            .n_unique()
+            .alias("candidates"),
+            pl.col("conversation_id")
+            .filter(pl.col("won"))
+            .n_unique()
+            .alias("candidate_wins"),
+            pl.col("prompt_eval_count").sum().alias("prompt_tokens"),
+            reused_tokens.sum().alias("reused_prompt_tokens"),
+            pl.col("eval_count").sum().alias("generated_tokens"),
+            pl.col("prompt_eval_duration").sum().alias("prompt_seconds"),
+            pl.col("eval_duration").sum().alias("generation_seconds"),
+            pl.col("load_duration").sum().alias("load_seconds"),
+            pl.col("total_duration").sum().alias("total_seconds"),
+            pl.col("total_duration")
+            .filter(~pl.col("final_reply"))
+            .sum()
+            .alias("seconds_lost"),
+        )
+        .with_columns(
+            (pl.col("generated_tokens") / pl.col("generation_seconds")).alias(
+                "tokens_per_second"
+            ),
+            (
+                pl.col("prompt_seconds")
+                / (pl.col("prompt_seconds") + pl.col("generation_seconds"))
+            ).alias("prompt_share"),
+            (pl.col("retries") / pl.col("successes")).alias("retries_per_success"),
+            (
+                pl.col("reused_prompt_tokens")
+                * pl.col("prompt_seconds")
+                / pl.col("prompt_tokens")
+            ).alias("prompt_seconds_saved"),
+        )
+        .sort(by)
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[-1])
+    parser.add_argument(
+        "--by",
+        choices=GROUPINGS,
+        nargs="+",
+        default=["expert"],
+        help="The columns to group responses by.",
+    )
+    parser.add_argument(
+        "--run", type=int, nargs="+", help="Only include responses from these runs."
+    )
+    parser.add_argument(
+        "--database",
+        type=str,
+        default=database.DB_NAME,
+        help="The sqlite file conversations were stored in.",
+    )
+    args = parser.parse_args()
+
+    database.configure(args.database)
+    with pl.Config(tbl_rows=-1, tbl_cols=-1, float_precision=2):
+        print(summarise(load_responses(run_ids=args.run), by=args.by))
@@ -0,0 +1,141 @@
+"""Run a dependency graph of stages, starting each stage as soon as its inputs are ready"""
+from typing import Any, Callable, NamedTuple
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from contextvars import ContextVar, copy_context
+import time
+from loguru import logger
+
+
+current_stage: ContextVar[str | None] = ContextVar("current_stage", default=None)
+"""The name of the stage being run in this context"""
+
+
+class Stage(NamedTuple):
+    name: str
+    inputs: tuple[str, ...]
+    """Names of the stages whose results are passed to `run` as kwargs"""
+    run: Callable[..., Any]
+
+
+class StageTiming(NamedTuple):
+    started: float
+    finished: float
+
+    @property
+    def duration(self) -> float:
+        return self.finished - self.started
+
+
+class Schedule(NamedTuple):
+    results: dict[str, Any]
+    timings: dict[str, StageTiming]
+    critical_path: list[str]
+    """The chain of stages that determined the total time taken"""
+
+    @property
+    def elapsed(self) -> float:
+        return max(t.finished for t in self.timings.values()) - min(
+            t.started for t in self.timings.values()
+        )
+
+    @property
+    def critical_path_duration(self) -> float:
+        return sum(self.timings[name].duration for name in self.critical_path)
+
+    @property
+    def total_stage_duration(self) -> float:
+        """Time it would have taken to run every stage one after the other"""
+        return sum(t.duration for t in self.timings.values())
+
+
+def check_stages(stages: list[Stage]) -> None:
+    """Raises a ValueError if any stage has unknown inputs, or stages form a cycle"""
+    names = {stage.name for stage in stages}
+    if len(names) != len(stages):
+        raise ValueError("Stage names must be unique")
+
+    for stage in stages:
+        unknown = set(stage.inputs) - names
+        if unknown:
+            raise ValueError(f"Stage {stage.name} has unknown inputs: {unknown}")
+
+    resolved: set[str] = set()
+    remaining = list(stages)
+    while remaining:
+        ready = [stage for stage in remaining if resolved.issuperset(stage.inputs)]
+        if not ready:
+            raise ValueError(
+                f"Stages have circular inputs: {[stage.name for stage in remaining]}"
+            )
+        resolved.update(stage.name for stage in ready)
+        remaining = [stage for stage in remaining if stage.name not in resolved]
+
+
+def find_critical_path(
+    stages: list[Stage], timings: dict[str, StageTiming]
+) -> list[str]:
+    """Walks back from the last stage to finish, following whichever input finished last"""
+    inputs = {stage.name: stage.inputs for stage in stages}
+    name = max(timings, key=lambda name: timings[name].finished)
+    path = [name]
+    while inputs[name]:
+        name = max(inputs[name], key=lambda name: timings[name].finished)
+        path.append(name)
+
+    return path[::-1]
+
+
+def run_stages(stages: list[Stage]) -> Schedule:
+    """Runs every stage once all of its inputs are available, running
+    independent stages at the same time. Raises as soon as a stage fails, without
+    waiting for the stages running alongside it."""
+    check_stages(stages)
+
+    results: dict[str, Any] = {}
+    timings: dict[str, StageTiming] = {}
+
+    def run_stage(stage: Stage) -> Any:
+        current_stage.set(stage.name)
+        started = time.perf_counter()
+        result = stage.run(**{name: results[name] for name in stage.inputs})
+        timings[stage.name] = StageTiming(started, time.perf_counter())
+        return result
+
+    pending = list(stages)
+    running: dict[Future, Stage] = {}
+    # not a with block, as leaving one waits for the stages that are still running
+    pool = ThreadPoolExecutor(max_workers=len(stages))
+    while pending or running:
+        ready = [stage for stage in pending if results.keys() >= set(stage.inputs)]
+        for stage in ready:
+            logger.debug(f"starting stage {stage.name}")
+            context = copy_context()
+            running[pool.submit(context.run, run_stage, stage)] = stage
+            pending.remove(stage)
+
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            stage = running.pop(future)
+            try:
+                results[stage.name] = future.result()
+            except Exception:
+                # stages that are running can't be stopped, they finish (and
+                # their results are dropped) in the background
+                pool.shutdown(wait=False, cancel_futures=True)
+                logger.error(f"stage {stage.name} failed")
+                raise
+    pool.shutdown()
+
+    schedule = Schedule(
+        results=results,
+        timings=timings,
+        critical_path=find_critical_path(stages, timings),
+    )
+    logger.info(
+        f"ran {len(stages)} stages in {schedule.elapsed:.1f}s "
+        f"(critical path {' -> '.join(schedule.critical_path)} took "
+        f"{schedule.critical_path_duration:.1f}s, stages took "
+        f"{schedule.total_stage_duration:.1f}s in total)"
+    )
+
+    return schedule
@@ -0,0 +1,68 @@
+"""Generating tables too large for one reply, saving each page to parquet as soon
+as it is validated, so a crash part way through a table loses at most one page"""
+from __future__ import annotations
+from pathlib import Path
+from typing import Any, Sequence, TYPE_CHECKING
+import polars as pl
+from loguru import logger
+
+from .checkpoints import write_parquet
+
+if TYPE_CHECKING:
+    from .polars_llm import PolarsLLM
+
+PAGE_GLOB = "page-*.parquet"
+
+
+def page_paths(directory: Path) -> list[Path]:
+    return sorted(directory.glob(PAGE_GLOB))
+
+
+def write_page(page: pl.DataFrame, directory: Path, number: int) -> Path:
+    """Writes a page atomically, so a partly written page is never read back"""
+    path = directory / f"page-{number:05d}.parquet"
+    write_parquet(page, path)
+    return path
+
+
+def read_pages(directory: Path) -> pl.LazyFrame:
+    return pl.scan_parquet(directory / PAGE_GLOB)
+
+
+def generate_table(
+    expert: PolarsLLM,
+    total_rows: int,
+    key_columns: Sequence[str],
+    directory: Path | None = None,
+    **kwargs: Any,
+) -> pl.LazyFrame:
+    """Generates `total_rows` rows a page at a time, see `PolarsLLM.generate_pages`.
+
+    With a `directory`, each page is written to parquet as it arrives, and pages
+    already in the directory are kept, so an interrupted table is carried on
+    rather than started again. Otherwise pages are kept in memory."""
+    if directory is None:
+        pages = list(expert.generate_pages(total_rows, key_columns, **kwargs))
+        if not pages:
+            raise Exception(f"Could not generate any rows for {expert.name}")
+        return pl.concat(pages).lazy()
+
+    directory.mkdir(parents=True, exist_ok=True)
+    existing = page_paths(directory)
+    seen = None
+    if existing:
+        seen = read_pages(directory).select(key_columns).collect()
+        logger.info(
+            f"{expert} carrying on from {seen.height} rows in {len(existing)} pages"
+        )
+
+    remaining = total_rows - (0 if seen is None else seen.height)
+    if remaining > 0:
+        pages = expert.generate_pages(remaining, key_columns, seen=seen, **kwargs)
+        for number, page in enumerate(pages, start=len(existing)):
+            write_page(page, directory, number)
+
+    if not page_paths(directory):
+        raise Exception(f"Could not generate any rows for {expert.name}")
+
+    return read_pages(directory).head(total_rows)
@@ -0,0 +1,98 @@
+"""Expanding a weekly timesheet pattern per job title into timesheets for every
+employee with that job title, over as many weeks as are needed.
+
+The LLM is only asked how a typical week is split between time codes for each job
+title, so the number of requests grows with the number of job titles rather than
+with the number of employees and days."""
+from __future__ import annotations
+from datetime import date, timedelta
+import polars as pl
+
+WEEKDAYS = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+
+TIMESHEET_WEEKS = 4
+"""Weeks of timesheets expanded from the patterns, by default"""
+
+HOURS_NOISE = 0.15
+"""Most hours can vary from the pattern by, as a share of the pattern's hours"""
+
+HOURS_STEP = 0.25
+"""Hours are rounded to a multiple of this, as they are on a timesheet"""
+
+
+def normalise_shares(patterns: pl.DataFrame) -> pl.DataFrame:
+    """Shares scaled to add up to 1 for each job title, as the LLM's rarely do"""
+    return patterns.filter(pl.col("share") > 0).with_columns(
+        pl.col("share") / pl.col("share").sum().over("job_title")
+    )
+
+
+def default_start(num_weeks: int) -> date:
+    """The Monday `num_weeks` weeks before this week, so the last week expanded is
+    the one just finished"""
+    today = date.today()
+    return today - timedelta(days=today.weekday(), weeks=num_weeks)
+
+
+def expand_timesheet_patterns(
+    hr: pl.DataFrame,
+    patterns: pl.DataFrame,
+    start: date | None = None,
+    num_weeks: int = TIMESHEET_WEEKS,
+    noise: float = HOURS_NOISE,
+    seed: int = 0,
+) -> pl.DataFrame:
+    """Timesheets for each employee in `hr` for `num_weeks` weeks from the week of
+    `start`, with each day's hours for a time code being the employee's
+    `weekly_hours` times the share of the week their job title's pattern gives it.
+
+    Hours vary by up to `noise` of the pattern's hours, by amounts drawn from a
+    generator seeded with `seed` in the order the timesheets are sorted, so
+    expanding the same patterns again gives the same timesheets. Employees whose
+    job title has no pattern get no timesheets, and days before an employee's hire
+    date are left out."""
+    import numpy as np
+
+    start = start or default_start(num_weeks)
+    monday = start - timedelta(days=start.weekday())
+    weeks = pl.date_range(
+        monday, monday + timedelta(weeks=num_weeks - 1), "1w", eager=True
+    ).alias("week_start")
+
+    employees = hr.lazy().select(
+        "employee_code",
+        "job_title",
+        "weekly_hours",
+        pl.col("hire_date").cast(pl.Date),
+    )
+    timesheets = (
+        employees.join(normalise_shares(patterns).lazy(), on="job_title")
+        .join(weeks.to_frame().lazy(), how="cross")
+        .with_columns(
+            date=pl.col("week_start")
+            + pl.duration(
+                days=pl.col("weekday").replace_strict(
+                    WEEKDAYS, range(len(WEEKDAYS)), return_dtype=pl.Int64
+                )
+            ),
+        )
+        .filter(pl.col("date") >= pl.col("hire_date"))
+        # every column that can differ, so the order doesn't depend on the joins
+        .sort("date", "employee_code", "time_code", "share", "weekly_hours")
+        .collect()
+    )
+    uniform = pl.Series(np.random.default_rng(seed).random(timesheets.height))
+
+    return (
+        timesheets.with_columns(
+            hours=(
+                pl.col("weekly_hours")
+                * pl.col("share")
+                * (1 + noise * (2 * uniform - 1))
+                / HOURS_STEP
+            ).round()
+            * HOURS_STEP
+        )
+        .filter(pl.col("hours") > 0)
+        .select("employee_code", "date", "weekday", "time_code", "hours")
+    )
@@ -0,0 +1,153 @@
+"""Running the tools a model calls, recording each call and its result"""
+from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from typing import Any, Callable, Mapping, Sequence
+import threading
+from loguru import logger
+
+from .cache import ToolCache, make_tool_cache_key
+from . import database
+
+DEFAULT_TOOL_CONCURRENCY = 4
+"""Calls in one message that are run at once"""
+
+
+class ToolExecutor:
+    """The tools given to a model, and the ids they're recorded under. Shared by
+    every conversation with the model, so tools are only registered once, and
+    hallucinated tools once each.
+
+    The calls in a message are independent of each other, so they're run at the
+    same time. With a `cache`, results are reused for calls with the same
+    arguments, including calls made in earlier runs."""
+
+    model_id: int
+    callables: dict[str, Callable]
+    tool_ids: dict[str, int]
+    cache: ToolCache | None
+    max_concurrency: int
+
+    def __init__(
+        self,
+        model_id: int,
+        tools: Sequence[Callable],
+        cache: ToolCache | None = None,
+        max_concurrency: int = DEFAULT_TOOL_CONCURRENCY,
+    ) -> None:
+        self.model_id = model_id
+        self.cache = cache
+        self.max_concurrency = max_concurrency
+        self.callables = {tool.__name__: tool for tool in tools}
+        self.tool_ids = {
+            tool.__name__: database.writer.insert_unique(
+                database.Tool,
+                model_id=model_id,
+                name=tool.__name__,
+                docstring=tool.__doc__,
+                annotations=str(tool.__annotations__),
+                is_hallucination=False,
+            )
+            for tool in tools
+        }
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"<ToolExecutor(model_id={self.model_id}, tools={list(self.callables)})>"
+
+    def tool_id(self, name: str) -> int:
+        with self._lock:
+            if name not in self.tool_ids:
+                # llm hallucinated for the first time, record it
+                self.tool_ids[name] = database.writer.insert_unique(
+                    database.Tool,
+                    model_id=self.model_id,
+                    name=name,
+                    is_hallucination=True,
+                )
+
+            return self.tool_ids[name]
+
+    def call(
+        self, name: str, arguments: Mapping[str, Any], message_id: int | None
+    ) -> str | None:
+        """Calls a tool, returning the formatted result (or None if the tool was
+        hallucinated)"""
+        tool_call_id = database.writer.insert(
+            database.ToolCall,
+            tool_id=self.tool_id(name),
+            arguments=arguments,
+            message_id=message_id,
+        )
+
+        # special case if hallucinated
+        if name not in self.callables:
+            database.writer.insert(
+                database.ToolResult,
+                call_id=tool_call_id,
+                was_error=True,
+                value_or_error="Hallucination",
+            )
+            return None
+
+        tool = self.callables[name]
+        key = None
+        value = None
+        if self.cache is not None:
+            key = make_tool_cache_key(tool, arguments)
+            value = self.cache.get(key)
+        was_cached = value is not None
+
+        if value is not None:
+            was_error, value_or_error = False, value
+        else:
+            # attempt to run tool
+            try:
+                result = tool(**arguments)
+            except Exception as e:
+                was_error, value_or_error = True, str(e)
+            else:
+                was_error, value_or_error = False, str(result)
+                if self.cache is not None and key is not None:
+                    self.cache.put(key, name, arguments, value_or_error)
+
+        database.writer.insert(
+            database.ToolResult,
+            call_id=tool_call_id,
+            was_error=was_error,
+            value_or_error=value_or_error,
+            was_cached=was_cached,
+        )
+
+        formatted_args = ", ".join(f"{k}={repr(v)}" for k, v in arguments.items())
+        return f"{name}({formatted_args}) = {value_or_error}"
+
+    def run(
+        self, calls: Sequence[Mapping[str, Any]], message_id: int | None
+    ) -> list[str | None]:
+        """Results of ollama's `tool_calls`, in the same order as the calls"""
+        if len(calls) <= 1:
+            return [
+                self.call(
+                    call["function"]["name"], call["function"]["arguments"], message_id
+                )
+                for call in calls
+            ]
+
+        logger.debug(f"{self} running {len(calls)} calls at once")
+        # each call runs in a copy of this context, so it's recorded against the
+        # same run and stage
+        contexts = [copy_context() for _ in calls]
+
+        def run_call(index: int, call: Mapping[str, Any]) -> str | None:
+            return contexts[index].run(
+                self.call,
+                call["function"]["name"],
+                call["function"]["arguments"],
+                message_id,
+            )
+
+        with ThreadPoolExecutor(
+            max_workers=min(self.max_concurrency, len(calls))
+        ) as pool:
+            return list(pool.map(run_call, range(len(calls)), calls))
@@ -0,0 +1,149 @@
+"""Details of pandera models compiled once per model, and validating generated
+dataframes with polars expressions"""
+from __future__ import annotations
+from functools import lru_cache
+from typing import Any, NamedTuple, Type, TYPE_CHECKING
+import string
+import polars as pl
+
+if TYPE_CHECKING:
+    from pandera.polars import DataFrameModel
+
+FAST_CHECKS = ("isin",)
+"""Pandera checks that can be made with polars expressions"""
+
+
+class CompiledSchema(NamedTuple):
+    model: Type[DataFrameModel]
+    columns: tuple[str, ...]
+    column_set: frozenset[str]
+    dtypes: dict[str, pl.DataType]
+    coerce: frozenset[str]
+    """Columns that are cast to their dtype, rather than checked"""
+    checks: dict[str, pl.Expr]
+    """Named expressions that are true when a dataframe passes the check"""
+    instruction: str
+    """The fields and data types, as they are described to the LLM"""
+    json_schema: dict[str, Any]
+    """JSON schema of an object with a `rows` array, for ollama's `format`"""
+    fast_path: bool
+    """Whether every check in the model can be made with polars expressions"""
+
+
+def format_pandera_model_as_instruction(model: Type[DataFrameModel]) -> str:
+    dtypes = model.to_schema().dtypes
+    result = "; ".join(
+        [
+            f"{col_name}={type(dtype).__name__.rstrip(string.digits).lower()}"
+            for col_name, dtype in dtypes.items()
+        ]
+    )
+
+    return result
+
+
+def json_type(dtype: pl.DataType) -> str:
+    if dtype.is_integer():
+        return "integer"
+    if dtype.is_numeric():
+        return "number"
+    if dtype == pl.Boolean:
+        return "boolean"
+    # dates are written as YYYY-MM-DD strings, as they are in csvs
+    return "string"
+
+
+def format_json_schema(model: Type[DataFrameModel]) -> dict[str, Any]:
+    schema = model.to_schema()
+    properties: dict[str, Any] = {}
+    for name, column in schema.columns.items():
+        field: dict[str, Any] = {"type": json_type(column.dtype.type)}
+        if column.nullable:
+            field["type"] = [field["type"], "null"]
+        for check in column.checks:
+            if check.name == "isin":
+                field["enum"] = list(check.statistics["allowed_values"])
+        properties[name] = field
+
+    return {
+        "type": "object",
+        "properties": {
+            "rows": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": properties,
+                    "required": list(properties),
+                },
+            }
+        },
+        "required": ["rows"],
+    }
+
+
+@lru_cache()
+def compile_schema(model: Type[DataFrameModel]) -> CompiledSchema:
+    schema = model.to_schema()
+    fast_path = not (schema.checks or schema.unique or schema.strict or schema.ordered)
+
+    checks: dict[str, pl.Expr] = {}
+    for name, column in schema.columns.items():
+        col = pl.col(name)
+        if not column.nullable:
+            checks[f"{name} not_nullable"] = col.is_not_null().all()
+        if column.unique:
+            checks[f"{name} unique"] = col.is_unique().all()
+        for check in column.checks:
+            if check.name == "isin":
+                allowed = list(check.statistics["allowed_values"])
+                checks[f"{name} isin"] = (col.is_in(allowed) | col.is_null()).all()
+        fast_path &= all(check.name in FAST_CHECKS for check in column.checks)
+        fast_path &= not column.regex
+
+    return CompiledSchema(
+        model=model,
+        columns=tuple(schema.columns),
+        column_set=frozenset(schema.columns),
+        dtypes={name: column.dtype.type for name, column in schema.columns.items()},
+        coerce=frozenset(
+            name
+            for name, column in schema.columns.items()
+            if schema.coerce or column.coerce
+        ),
+        checks=checks,
+        instruction=format_pandera_model_as_instruction(model),
+        json_schema=format_json_schema(model),
+        fast_path=fast_path,
+    )
+
+
+def fast_validate(df: pl.DataFrame, schema: CompiledSchema) -> pl.DataFrame | None:
+    """The coerced dataframe if it passes every check, otherwise None"""
+    if not schema.column_set <= set(df.columns):
+        return None
+
+    try:
+        df = df.with_columns(
+            pl.col(name).cast(schema.dtypes[name]) for name in schema.coerce
+        )
+    except pl.exceptions.PolarsError:
+        return None
+
+    if any(df.schema[name] != dtype for name, dtype in schema.dtypes.items()):
+        return None
+
+    if schema.checks and not all(df.select(**schema.checks).row(0)):
+        return None
+
+    return df
+
+
+def validate(df: pl.DataFrame, schema: CompiledSchema) -> pl.DataFrame:
+    """Validates with polars expressions when the model allows it. Falls back to
+    pandera, which explains what was wrong, if any check fails."""
+    if schema.fast_path:
+        validated = fast_validate(df, schema)
+        if validated is not None:
+            return validated
+
+    return schema.model.validate(df, lazy=True)